@@ -216,6 +216,30 @@ webpage_export = [
 # ---------------
 # Hook on document methods and events
 
+doc_events = {
+    "Subscription Plan": {
+        "on_update": [
+            "zerp.zerp.server_scripts.plan_snapshot.on_plan_update",
+            "zerp.zerp.server_scripts.plan_catalog.clear_plan_catalog",
+            "zerp.zerp.server_scripts.public_pages.refresh_public_pages"
+        ],
+        "on_trash": [
+            "zerp.zerp.server_scripts.plan_catalog.clear_plan_catalog",
+            "zerp.zerp.server_scripts.public_pages.refresh_public_pages"
+        ],
+        "after_rename": [
+            "zerp.zerp.server_scripts.plan_catalog.clear_plan_catalog",
+            "zerp.zerp.server_scripts.public_pages.refresh_public_pages"
+        ]
+    },
+    "Zerp Settings": {
+        "on_update": [
+            "zerp.zerp.server_scripts.stripe_gateway.clear_stripe_settings",
+            "zerp.zerp.server_scripts.public_pages.refresh_public_pages"
+        ]
+    }
+}
+
 # doc_events = {
 # 	"*": {
 # 		"on_update": "method",
@@ -227,6 +251,27 @@ webpage_export = [
 # Scheduled Tasks
 # ---------------
 
+scheduler_events = {
+    "all": [
+        "zerp.zerp.server_scripts.provisioning_scheduler.dispatch_provisioning",
+        "zerp.zerp.webhook_inbox.drain_webhook_inbox"
+    ],
+    "hourly": [
+        "zerp.zerp.server_scripts.provisioning_scheduler.requeue_stalled_provisioning",
+        "zerp.zerp.server_scripts.bench_hosts.check_bench_hosts",
+        "zerp.zerp.server_scripts.site_teardown.requeue_stalled_teardowns"
+    ],
+    "hourly_long": [
+        "zerp.zerp.server_scripts.site_pool.refill_site_pools",
+        "zerp.zerp.server_scripts.dns_reconciler.reconcile_dns",
+        "zerp.zerp.server_scripts.site_archive.process_site_archives"
+    ],
+    "daily_long": [
+        "zerp.zerp.server_scripts.plan_snapshot.refresh_plan_snapshots",
+        "zerp.zerp.server_scripts.site_teardown.queue_expired_purge"
+    ]
+}
+
 # scheduler_events = {
 # 	"all": [
 # 		"zerp.tasks.all"
@@ -317,7 +362,7 @@ webpage_export = [
 # Automatically update python controller files with type annotations for this app.
 # export_python_type_annotations = True
 
-# default_log_clearing_doctypes = {
-# 	"Logging DocType Name": 30  # days to retain logs
-# }
+default_log_clearing_doctypes = {
+    "Provisioning Log": 30  # days to retain logs
+}
 
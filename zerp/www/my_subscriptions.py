@@ -1,5 +1,10 @@
 import frappe
 from frappe import _
+from zerp.zerp.server_scripts.site_teardown import get_teardown_status, submit_teardown
+from zerp.zerp.server_scripts.user_subscriptions import get_user_subscriptions, get_user_summary
+
+# Without a filter cancelled subscriptions are left out
+STATUS_FILTERS = ("", "All", "Draft", "Active", "Expired", "Cancelled")
 
 def get_context(context):
     if frappe.session.user == 'Guest':
@@ -7,24 +12,53 @@ def get_context(context):
     
     context.no_cache = 1
     context.base_domain = "zaynerp.com"
-    context.subscriptions = get_user_subscriptions()
+    context.status = get_status_filter(frappe.form_dict.get('status'))
+
+    summary = get_user_summary(frappe.session.user, context.status)
+    context.status_counts = summary["counts"]
+    context.subscriptions = summary["page"]["subscriptions"]
+    context.next_cursor = summary["page"]["next_cursor"]
+    set_teardown_status(context.subscriptions)
+
+def get_status_filter(status):
+    return status if status in STATUS_FILTERS else ""
 
-def get_user_subscriptions():
-    # Fetch all subscriptions for the current user
-    subscriptions = frappe.get_all(
-        "Subscription",
+def set_teardown_status(subscriptions):
+    """Mark subscriptions whose site deletion is still in progress"""
+    if not subscriptions:
+        return
+
+    teardowns = dict(frappe.get_all(
+        "Site Teardown",
         filters={
-            "user": frappe.session.user
+            "subscription": ["in", [sub.name for sub in subscriptions]],
+            "status": ["in", ["Queued", "Running", "Failed"]]
         },
-        fields=[
-            "name", "sub_domain", "plan", "plan_name", 
-            "plan_monthly_subscription", "start_date", 
-            "end_date", "status", "is_site_created", 
-            "site_url"
-        ],
-        order_by="creation desc"
-    )
-    return subscriptions
+        fields=["subscription", "status"],
+        as_list=True
+    ))
+    for sub in subscriptions:
+        sub.teardown_status = teardowns.get(sub.name)
+
+@frappe.whitelist()
+def get_subscriptions_page(cursor, status=""):
+    """Return the rendered rows of the next page of the user's subscriptions"""
+    if frappe.session.user == 'Guest':
+        frappe.throw(_("Please login to view subscriptions"), frappe.PermissionError)
+
+    page = get_user_subscriptions(frappe.session.user, get_status_filter(status), cursor)
+    set_teardown_status(page["subscriptions"])
+
+    return {
+        "html": "".join(
+            frappe.render_template(
+                "templates/includes/subscription_row.html",
+                {"sub": sub, "base_domain": "zaynerp.com"}
+            )
+            for sub in page["subscriptions"]
+        ),
+        "next_cursor": page["next_cursor"]
+    }
 
 @frappe.whitelist()
 def cancel_subscription(subscription):
@@ -39,75 +73,14 @@ def cancel_subscription(subscription):
         if sub_doc.user != frappe.session.user:
             frappe.throw(_("You don't have permission to cancel this subscription"))
         
-        # Check if site is created
+        # Drop the site in the background; the subscription is cancelled once it is gone
         if sub_doc.is_site_created and sub_doc.status == "Active":
-            # Get MySQL root password from Zerp Settings
-            settings = frappe.get_single("Zerp Settings")
-            if not settings or not settings.mysql_root_password:
-                frappe.throw(_("System configuration error: MySQL root password not found"))
-            
-            # Get base domain
-            base_domain = getattr(settings, 'base_domain', "ventotech.co")
-            
-            # Prepare site name
-            site_name = f"{sub_doc.sub_domain}.{base_domain}"
-            
-            # Log site deletion attempt
-            frappe.log_error(message=f"Site deletion started for {site_name}", title="Site Deletion")
-            
-            try:
-                # Import needed modules
-                import subprocess
-                import os
-                from frappe.utils import get_bench_path
-                
-                # Get bench path
-                bench_path = get_bench_path()
-                
-                # Execute bench drop-site command
-                process = subprocess.Popen(
-                    [
-                        "bench", "drop-site", site_name,
-                        "--force",
-                        "--mariadb-root-password", settings.mysql_root_password
-                    ],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    cwd=bench_path
-                )
-                
-                # Wait for process to complete with timeout
-                try:
-                    stdout, stderr = process.communicate(timeout=300)  # 5 minutes timeout
-                    
-                    # Log output
-                    log_output = f"Site Deletion Output for {site_name}:\nSTDOUT: {stdout.decode()}\nSTDERR: {stderr.decode()}"
-                    frappe.log_error(message=log_output, title="Site Deletion Output")
-                    
-                    # Check if successful
-                    if process.returncode != 0:
-                        error_msg = f"Site deletion failed with code {process.returncode}: {stderr.decode()}"
-                        frappe.log_error(message=error_msg, title="Site Deletion Error")
-                        frappe.throw(error_msg)
-                    
-                except subprocess.TimeoutExpired:
-                    # Kill the process if it times out
-                    process.kill()
-                    stdout, stderr = process.communicate()
-                    error_msg = f"Site deletion timed out: {stderr.decode()}"
-                    frappe.log_error(message=error_msg, title="Site Deletion Timeout")
-                    frappe.throw(error_msg)
-                
-                # Add comment about site deletion
-                sub_doc.add_comment("Comment", f"Site {site_name} was deleted")
-                
-            except Exception as site_error:
-                # Log detailed error
-                frappe.log_error(
-                    message=f"Error deleting site {site_name}: {str(site_error)}\n{frappe.get_traceback()}",
-                    title="Site Deletion Error"
-                )
-                frappe.throw(f"Error deleting site: {str(site_error)}")
+            submit_teardown(sub_doc.name, "Cancellation")
+            return {
+                "success": True,
+                "queued": True,
+                "message": _("Cancellation has been queued, your site is being deleted")
+            }
         
         # Update subscription status
         sub_doc.status = "Cancelled"
@@ -123,4 +96,12 @@ def cancel_subscription(subscription):
         return {
             "success": False,
             "message": str(e)
-        }
\ No newline at end of file
+        }
+
+@frappe.whitelist()
+def get_cancellation_progress(subscription):
+    """Return the progress of the site deletion of one of the user's subscriptions"""
+    if frappe.db.get_value("Subscription", subscription, "user") != frappe.session.user:
+        frappe.throw(_("You don't have permission to view this subscription"), frappe.PermissionError)
+    
+    return get_teardown_status(subscription)
@@ -2,36 +2,22 @@ import frappe
 from frappe import _
 import stripe
 import json
-
-no_cache = 1
+from zerp.zerp.server_scripts.plan_catalog import get_plan_catalog
+from zerp.zerp.server_scripts.checkout import TRIAL_DAYS, get_idempotency_key, queue_checkout_followup
+from zerp.zerp.server_scripts.stripe_gateway import get_client, get_stripe_settings
+from zerp.zerp.server_scripts.stripe_lookup import get_user_customer, set_user_customer
+from zerp.zerp.server_scripts.subdomains import check_subdomain, reserve_subdomain
 
 def get_context(context):
-    # Get Stripe settings
-    settings = frappe.get_single("Zerp Settings")
-    context.stripe_publishable_key = settings.stripe_publishable_key
-    stripe.api_key = settings.stripe_secret_key
-    
+    # Rendered once for all visitors and kept in the website cache; the
+    # selected plan, subdomain and login state are filled in by the page script
+    context.stripe_publishable_key = get_stripe_settings().publishable_key
     context.subscription_plans = get_subscription_plans()
-    context.no_cache = 1
     context.base_domain = "zaynerp.com"
-    context.is_user_logged_in = frappe.session.user != 'Guest'
-    
-    if frappe.form_dict:
-        context.subdomain = frappe.form_dict.get('subdomain', '')
-        context.selected_plan = frappe.form_dict.get('plan', '')
 
 def get_subscription_plans():
     try:
-        return frappe.get_all(
-            "Subscription Plan",
-            fields=[
-                "name",
-                "plan_name",
-                "plan_monthly_subscription",
-                "plan_description"
-            ],
-            order_by="plan_monthly_subscription asc"
-        )
+        return get_plan_catalog()
     except Exception as e:
         frappe.log_error(f"Error in get_subscription_plans: {str(e)}")
         return []
@@ -44,6 +30,17 @@ def check_user_login():
         "is_logged_in": is_logged_in
     }
 
+@frappe.whitelist(allow_guest=True)
+def check_subdomain_availability(subdomain):
+    """Availability of a subdomain as the visitor types, with free alternatives if it is taken"""
+    user = frappe.session.user if frappe.session.user != 'Guest' else None
+    return check_subdomain(subdomain, user)
+
+@frappe.whitelist()
+def reserve_checkout_subdomain(subdomain):
+    """Hold a subdomain for the user while they enter their payment details"""
+    return reserve_subdomain(subdomain, frappe.session.user)
+
 @frappe.whitelist()
 def create_payment_intent(plan, subdomain):
     """Create a payment intent for the subscription"""
@@ -54,10 +51,11 @@ def create_payment_intent(plan, subdomain):
         if not subdomain:
             return {"success": False, "message": "Subdomain is required"}
         
-        # Check if subdomain already exists
-        existing = frappe.db.exists("Subscription", {"sub_domain": subdomain})
-        if existing:
-            return {"success": False, "message": "This subdomain is already taken. Please choose another one."}
+        # Hold the subdomain before anything is charged
+        reservation = reserve_subdomain(subdomain, frappe.session.user)
+        if not reservation["available"]:
+            return {"success": False, "message": reservation["message"], "suggestions": reservation["suggestions"]}
+        subdomain = reservation["subdomain"]
         
         # Get plan details
         plan_doc = frappe.get_doc("Subscription Plan", plan)
@@ -69,17 +67,17 @@ def create_payment_intent(plan, subdomain):
         
         # Create payment intent
         try:
-            payment_intent = stripe.PaymentIntent.create(
-                amount=amount,
-                currency="usd",
-                payment_method_types=["card"],
-                description=f"Subscription for {plan_doc.plan_name} - {subdomain}",
-                metadata={
+            payment_intent = get_client().payment_intents.create(params={
+                "amount": amount,
+                "currency": "usd",
+                "payment_method_types": ["card"],
+                "description": f"Subscription for {plan_doc.plan_name} - {subdomain}",
+                "metadata": {
                     "plan": plan,
                     "subdomain": subdomain,
                     "user": frappe.session.user
                 }
-            )
+            })
             
             return {
                 "success": True,
@@ -99,10 +97,6 @@ def create_payment_intent(plan, subdomain):
 def create_subscription(plan, subdomain, payment_method_id):
     """Create a subscription with trial period"""
     try:
-        # Get Stripe settings
-        settings = frappe.get_single("Zerp Settings")
-        stripe.api_key = settings.stripe_secret_key
-
         # Validate inputs
         if not plan:
             return {"success": False, "message": "Plan is required"}
@@ -111,10 +105,11 @@ def create_subscription(plan, subdomain, payment_method_id):
         if not payment_method_id:
             return {"success": False, "message": "Payment method is required"}
         
-        # Check if subdomain already exists
-        existing = frappe.db.exists("Subscription", {"sub_domain": subdomain})
-        if existing:
-            return {"success": False, "message": "This subdomain is already taken. Please choose another one."}
+        # Hold the subdomain before anything is charged
+        reservation = reserve_subdomain(subdomain, frappe.session.user)
+        if not reservation["available"]:
+            return {"success": False, "message": reservation["message"], "suggestions": reservation["suggestions"]}
+        subdomain = reservation["subdomain"]
         
         # Get plan details
         plan_doc = frappe.get_doc("Subscription Plan", plan)
@@ -125,68 +120,63 @@ def create_subscription(plan, subdomain, payment_method_id):
             return {"success": False, "message": "Plan not properly configured"}
         
         try:
-            # Create or get customer from existing subscriptions
-            customer_id = frappe.db.get_value(
-                "Subscription",
-                {
-                    "user": frappe.session.user,
-                    "stripe_customer_id": ("!=", "")
-                },
-                "stripe_customer_id"
-            )
+            client = get_client()
+            user = frappe.session.user
+
+            # Reuse the customer of the user's earlier subscriptions
+            customer_id = get_user_customer(user)
+            existing_customer = bool(customer_id)
             
-            if not customer_id:
-                # Create new customer
-                customer = stripe.Customer.create(
-                    email=frappe.session.user,
-                    payment_method=payment_method_id,
-                    invoice_settings={
-                        'default_payment_method': payment_method_id
-                    }
+            if not existing_customer:
+                # A new customer gets the card attached and set as default in the same call
+                customer = client.customers.create(
+                    params={
+                        'email': user,
+                        'payment_method': payment_method_id,
+                        'invoice_settings': {
+                            'default_payment_method': payment_method_id
+                        }
+                    },
+                    options={'idempotency_key': get_idempotency_key('customer', user, payment_method_id)}
                 )
                 customer_id = customer.id
-                
-                # Save customer ID to user
-                frappe.db.set_value("User", frappe.session.user, "stripe_customer_id", customer_id)
-                frappe.db.commit()
-
-            # Attach payment method to customer if not already attached
-            try:
-                stripe.PaymentMethod.attach(
-                    payment_method_id,
-                    customer=customer_id,
-                )
-            except stripe.error.InvalidRequestError as e:
-                if "already been attached" not in str(e):
-                    raise
-
-            # Set as default payment method
-            stripe.Customer.modify(
-                customer_id,
-                invoice_settings={
-                    'default_payment_method': payment_method_id
-                }
-            )
+                set_user_customer(user, customer_id)
+            else:
+                # Attach payment method to customer if not already attached
+                try:
+                    client.payment_methods.attach(
+                        payment_method_id,
+                        params={'customer': customer_id},
+                        options={'idempotency_key': get_idempotency_key('attach', customer_id, payment_method_id)}
+                    )
+                except stripe.error.InvalidRequestError as e:
+                    if "already been attached" not in str(e):
+                        raise
             
-            # Create subscription
-            subscription = stripe.Subscription.create(
-                customer=customer_id,
-                items=[{'price': plan_doc.stripe_price_id}],
-                trial_period_days=14,  # 14 days trial
-                payment_behavior='default_incomplete',
-                payment_settings={'payment_method_types': ['card']},
-                expand=['latest_invoice.payment_intent'],
-                metadata={
-                    'subdomain': subdomain,
-                    'plan': plan,
-                    'user': frappe.session.user
-                }
+            # Create subscription; it pays with the card directly, the customer's
+            # default is updated in the background
+            subscription = client.subscriptions.create(
+                params={
+                    'customer': customer_id,
+                    'items': [{'price': plan_doc.stripe_price_id}],
+                    'default_payment_method': payment_method_id,
+                    'trial_period_days': TRIAL_DAYS,
+                    'payment_behavior': 'default_incomplete',
+                    'payment_settings': {'payment_method_types': ['card']},
+                    'expand': ['latest_invoice.payment_intent'],
+                    'metadata': {
+                        'subdomain': subdomain,
+                        'plan': plan,
+                        'user': user
+                    }
+                },
+                options={'idempotency_key': get_idempotency_key('subscription', user, subdomain, payment_method_id)}
             )
             
             # Create subscription record
             doc = frappe.get_doc({
                 "doctype": "Subscription",
-                "user": frappe.session.user,
+                "user": user,
                 "sub_domain": subdomain,
                 "subscription_type": "Trial",
                 "plan": plan,
@@ -194,13 +184,14 @@ def create_subscription(plan, subdomain, payment_method_id):
                 "status": "Active",
                 "stripe_customer_id": customer_id,
                 "stripe_subscription_id": subscription.id,
-                "trial_end_date": frappe.utils.add_days(None, 14),  # 14 days from now
-                "next_billing_date": frappe.utils.add_days(None, 14)  # Same as trial end
+                "trial_end_date": frappe.utils.add_days(None, TRIAL_DAYS),
+                "next_billing_date": frappe.utils.add_days(None, TRIAL_DAYS)  # Same as trial end
             })
             
+            # Site creation and the customer's default card are handled after the response
+            doc.flags.defer_site_creation = True
             doc.insert(ignore_permissions=True)
-            
-            # Site creation will be handled by subscription doctype's after_insert
+            queue_checkout_followup(doc.name, customer_id, payment_method_id, update_default_payment_method=existing_customer)
             
             return {
                 "success": True,
@@ -1,7 +1,8 @@
 import frappe
 from frappe import _
 import stripe
-from .stripe_webhooks import handle_webhook
+from .webhook_inbox import store_event
+from zerp.zerp.server_scripts.stripe_gateway import get_stripe_settings
 
 @frappe.whitelist(allow_guest=True)
 def stripe_webhook():
@@ -10,8 +11,8 @@ def stripe_webhook():
         frappe.throw(_("Invalid request method"))
         
     # Get Stripe webhook secret from settings
-    settings = frappe.get_single("Zerp Settings")
-    if not settings.stripe_webhook_secret:
+    webhook_secret = get_stripe_settings().webhook_secret
+    if not webhook_secret:
         frappe.throw(_("Stripe webhook secret not configured"))
         
     # Verify webhook signature
@@ -19,11 +20,13 @@ def stripe_webhook():
         event = stripe.Webhook.construct_event(
             frappe.request.data,
             frappe.request.headers.get('Stripe-Signature'),
-            settings.stripe_webhook_secret
+            webhook_secret
         )
     except ValueError as e:
         frappe.throw(_("Invalid payload"))
     except stripe.error.SignatureVerificationError as e:
         frappe.throw(_("Invalid signature"))
-        
-    return handle_webhook(frappe.request)
\ No newline at end of file
+    
+    # Acknowledge right away, the event is processed from the inbox in the background
+    store_event(event, frappe.request.data)
+    return {"success": True}
\ No newline at end of file
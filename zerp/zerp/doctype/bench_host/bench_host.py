@@ -0,0 +1,18 @@
+# Copyright (c) 2024, Zerp and contributors
+# For license information, please see license.txt
+
+import os
+
+import frappe
+from frappe.model.document import Document
+
+
+class BenchHost(Document):
+    def validate(self):
+        if not os.path.isabs(self.bench_path):
+            frappe.throw("Bench Path must be an absolute path")
+
+        self.bench_path = os.path.normpath(self.bench_path)
+
+        if self.capacity < 1:
+            frappe.throw("Capacity must be at least 1")
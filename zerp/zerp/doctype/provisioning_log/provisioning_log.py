@@ -0,0 +1,15 @@
+# Copyright (c) 2024, Zerp and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+from frappe.query_builder import Interval
+from frappe.query_builder.functions import Now
+
+
+class ProvisioningLog(Document):
+    @staticmethod
+    def clear_old_logs(days=30):
+        """Called by Log Settings to prune entries past the retention period"""
+        table = frappe.qb.DocType("Provisioning Log")
+        frappe.db.delete(table, filters=(table.creation < (Now() - Interval(days=days))))
@@ -0,0 +1,129 @@
+# Copyright (c) 2024, Zerp and contributors
+# For license information, please see license.txt
+
+import time
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import cint, now_datetime
+
+from zerp.zerp.server_scripts.command_runner import new_run_id
+
+
+class SiteProvisioning(Document):
+    progress_event = "zerp_provisioning_progress"
+
+    def has_completed_steps(self):
+        return any(row.status == "Completed" for row in self.steps)
+
+    def get_step(self, key, step_name):
+        """Return the row of a step, adding it on first use"""
+        for row in self.steps:
+            if row.step_key == key:
+                return row
+
+        row = self.append("steps", {
+            "step_key": key,
+            "step_name": step_name,
+            "status": "Pending"
+        })
+        row.db_insert()
+        return row
+
+    def run_steps(self, steps, bench_path, log_messages):
+        """Run the steps that have not completed yet, persisting each outcome.
+
+        A step may provide `is_done` to detect work finished by an attempt
+        that died before recording it, and `retry_command` to use on retries.
+        log_messages is a RunLog, flushed to Provisioning Log after every step.
+        """
+        from zerp.zerp.server_scripts.site_creation import execute_steps
+
+        for step in steps:
+            row = self.get_step(step['key'], step['name'])
+            log_messages.step = step['name']
+
+            if row.status == "Completed":
+                log_messages.append(f"Skipping completed step: {step['name']}")
+                continue
+
+            if step.get('is_done') and step['is_done']():
+                row.db_set({"status": "Completed", "error": None}, update_modified=False)
+                frappe.db.commit()
+                self.publish_progress(row)
+                log_messages.append(f"Step already done: {step['name']}")
+                log_messages.flush()
+                continue
+
+            if cint(row.attempts) and step.get('retry_command'):
+                step = dict(step, command=step['retry_command'])
+
+            row.db_set({
+                "status": "Running",
+                "attempts": cint(row.attempts) + 1,
+                "started_at": now_datetime(),
+                "error": None
+            }, update_modified=False)
+            frappe.db.commit()
+            self.publish_progress(row)
+
+            start = time.monotonic()
+            try:
+                execute_steps([step], bench_path, log_messages, self.run_id)
+            except Exception as e:
+                row.db_set({
+                    "status": "Failed",
+                    "duration": round(time.monotonic() - start, 2),
+                    "error": str(e)[:1000]
+                }, update_modified=False)
+                frappe.db.commit()
+                self.publish_progress(row)
+                log_messages.flush()
+                raise
+
+            row.db_set({
+                "status": "Completed",
+                "duration": round(time.monotonic() - start, 2)
+            }, update_modified=False)
+            frappe.db.commit()
+            self.publish_progress(row)
+            log_messages.flush()
+
+        log_messages.step = None
+
+    def publish_progress(self, row=None):
+        """Push the state of the run to the subscriber's portal and to desk users viewing the subscription"""
+        message = {
+            "name": self.name,
+            "subscription": self.subscription,
+            "status": self.status,
+            "step": row.step_name if row else None,
+            "step_status": row.status if row else None
+        }
+
+        user = frappe.db.get_value("Subscription", self.subscription, "user")
+        if user:
+            frappe.publish_realtime(self.progress_event, message, user=user)
+
+        frappe.publish_realtime(
+            self.progress_event, message, doctype="Subscription", docname=self.subscription
+        )
+
+
+def get_provisioning(subscription_name):
+    """Return the unfinished provisioning record of the subscription, or a new one"""
+    name = frappe.db.get_value(
+        "Site Provisioning",
+        {"subscription": subscription_name, "status": ["!=", "Completed"]},
+        "name",
+        order_by="creation desc"
+    )
+    if name:
+        return frappe.get_doc("Site Provisioning", name)
+
+    return frappe.get_doc({
+        "doctype": "Site Provisioning",
+        "subscription": subscription_name,
+        "status": "Pending",
+        "run_id": new_run_id(subscription_name)
+    }).insert(ignore_permissions=True)
@@ -0,0 +1,11 @@
+# Copyright (c) 2024, Zerp and contributors
+# For license information, please see license.txt
+
+import frappe
+
+from zerp.zerp.doctype.site_provisioning.site_provisioning import SiteProvisioning
+
+
+class SiteTeardown(SiteProvisioning):
+    # Steps are checkpointed and reported exactly like site creation
+    progress_event = "zerp_teardown_progress"
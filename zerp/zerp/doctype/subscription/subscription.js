@@ -1,5 +1,62 @@
 frappe.ui.form.on('Subscription', {
+    onload: function(frm) {
+        // Follow a site deletion running in the background; onload runs for
+        // every form load, so the handler of the previous one is dropped first
+        frappe.realtime.off('zerp_teardown_progress');
+        frappe.realtime.on('zerp_teardown_progress', function(data) {
+            if (data.subscription !== frm.doc.name) {
+                return;
+            }
+
+            if (data.step) {
+                frappe.show_alert({
+                    message: __('{0}: {1}', [data.step, data.step_status]),
+                    indicator: data.step_status === 'Failed' ? 'red' : 'blue'
+                });
+            }
+
+            if (['Completed', 'Failed'].includes(data.status)) {
+                frm.reload_doc();
+            }
+        });
+    },
+
     refresh: function(frm) {
+        // Show the progress of a queued or running site deletion
+        let teardown = frm.doc.__onload && frm.doc.__onload.teardown;
+        if (teardown) {
+            let steps = teardown.steps.map(function(step) {
+                return `${step.step}: ${step.status}`;
+            }).join(', ');
+            frm.dashboard.set_headline(
+                __('Site deletion {0}', [teardown.status.toLowerCase()])
+                + (steps ? ` (${steps})` : '')
+                + (teardown.error ? `<br>${frappe.utils.escape_html(teardown.error)}` : ''),
+                teardown.status === 'Failed' ? 'red' : 'blue'
+            );
+        }
+
+        // Show the latest provisioning log entries
+        let log = frm.doc.__onload && frm.doc.__onload.provisioning_log;
+        if (log && log.length) {
+            let rows = log.map(function(entry) {
+                let indicator = {Error: 'red', Warning: 'orange'}[entry.level] || 'gray';
+                return `<tr>
+                    <td class="text-muted">${frappe.datetime.str_to_user(entry.logged_at)}</td>
+                    <td><span class="indicator-pill ${indicator}">${__(entry.level)}</span></td>
+                    <td>${frappe.utils.escape_html(entry.step || '')}</td>
+                    <td>${frappe.utils.escape_html((entry.message || '').split('\n')[0])}</td>
+                </tr>`;
+            }).join('');
+            frm.dashboard.add_section(
+                `<table class="table table-condensed small">${rows}</table>
+                <a href="/app/provisioning-log?subscription=${encodeURIComponent(frm.doc.name)}">
+                    ${__('View full log')}
+                </a>`,
+                __('Provisioning Log')
+            );
+        }
+
         // Add delete site button if site exists
         if (frm.doc.__onload && frm.doc.__onload.show_delete_site_button) {
             frm.add_custom_button(__('Delete Site'), function() {
@@ -9,8 +66,6 @@ frappe.ui.form.on('Subscription', {
                         frappe.call({
                             method: 'delete_site',
                             doc: frm.doc,
-                            freeze: true,
-                            freeze_message: __('Deleting site...'),
                             callback: function(r) {
                                 if (r.message && r.message.success) {
                                     frappe.msgprint({
@@ -32,5 +87,25 @@ frappe.ui.form.on('Subscription', {
                 );
             }, __('Actions'));
         }
+
+        // Add retry button if provisioning failed part way
+        if (frm.doc.__onload && frm.doc.__onload.show_retry_provisioning_button) {
+            frm.add_custom_button(__('Retry Site Creation'), function() {
+                frappe.call({
+                    method: 'retry_provisioning',
+                    doc: frm.doc,
+                    callback: function(r) {
+                        if (r.message && r.message.success) {
+                            frappe.msgprint({
+                                title: __('Queued'),
+                                message: r.message.message,
+                                indicator: 'green'
+                            });
+                            frm.reload_doc();
+                        }
+                    }
+                });
+            }, __('Actions'));
+        }
     }
 });
\ No newline at end of file
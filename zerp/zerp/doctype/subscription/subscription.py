@@ -5,26 +5,38 @@ import frappe
 from frappe import _
 from frappe.model.document import Document
 import subprocess
-from frappe.utils import get_bench_path, nowdate, getdate
+from frappe.utils import nowdate, getdate
 import os
-import re
+from zerp.zerp.server_scripts.bench_hosts import refresh_tenant_count, select_bench_host
+from zerp.zerp.server_scripts.provisioning_log import get_recent_logs
+from zerp.zerp.server_scripts.provisioning_scheduler import submit_provisioning
+from zerp.zerp.server_scripts.site_teardown import get_teardown_status, submit_teardown
+from zerp.zerp.server_scripts.stripe_lookup import remove_stripe_ids, update_stripe_ids
+from zerp.zerp.server_scripts.subdomains import (
+    clear_taken,
+    get_format_error,
+    get_pattern_error,
+    get_reservation_owner,
+    release_subdomain,
+)
+from zerp.zerp.server_scripts.user_subscriptions import clear_user_summary
 
 class Subscription(Document):
     def validate(self):
-        if not self.sub_domain:
-            frappe.throw("Subdomain is required")
-        
-        # Basic subdomain validation
-        if not re.match("^[a-z0-9][a-z0-9-]*[a-z0-9]$", self.sub_domain):
-            frappe.throw("Invalid subdomain. Use only lowercase letters, numbers, and hyphens")
-            
-        # Check subdomain uniqueness
-        existing = frappe.db.exists("Subscription", {
-            "sub_domain": self.sub_domain,
-            "name": ["!=", self.name]
-        })
-        if existing:
-            frappe.throw(f"Subdomain {self.sub_domain} is already in use")
+        error = get_pattern_error(self.sub_domain)
+        if error:
+            frappe.throw(error)
+            
+        # Uniqueness is enforced by the unique index; refuse a subdomain held by another checkout
+        if self.is_new() or self.has_value_changed("sub_domain"):
+            # Reserved words and the length limit came later, existing subscriptions keep their subdomain
+            error = get_format_error(self.sub_domain)
+            if error:
+                frappe.throw(error)
+
+            owner = get_reservation_owner(self.sub_domain)
+            if owner and owner != self.user:
+                frappe.throw(f"Subdomain {self.sub_domain} is already in use")
             
         # Set default dates if not provided
         if not self.start_date:
@@ -34,23 +46,49 @@ class Subscription(Document):
         if not self.plan:
             frappe.throw("Subscription Plan is required")
 
+    def before_insert(self):
+        # Place the site on the least loaded bench host
+        if not self.bench_host:
+            self.bench_host = select_bench_host()
+
+    def on_update(self):
+        # A cancelled subscription frees its slot on the bench host
+        if self.has_value_changed("status") and self.status == "Cancelled":
+            refresh_tenant_count(self.bench_host)
+
+        # Keep the Stripe id lookup used by webhooks current
+        update_stripe_ids(self)
+
+    def on_change(self):
+        # Also runs on db_set, the owner's cached subscription list is rebuilt on the next view
+        clear_user_summary(self.user)
+        before = self.get_doc_before_save()
+        if before and before.user != self.user:
+            clear_user_summary(before.user)
+        if before and before.sub_domain != self.sub_domain:
+            clear_taken(before.sub_domain)
+            clear_taken(self.sub_domain)
+
+    def on_trash(self):
+        remove_stripe_ids(self)
+        clear_user_summary(self.user)
+        clear_taken(self.sub_domain)
+
     def after_insert(self):
         """After the document is saved and committed, queue the site creation"""
+        # The subdomain is taken for good now
+        clear_taken(self.sub_domain)
+        release_subdomain(self.sub_domain)
+
         # Ensure we're not re-triggering site creation
         if self.is_site_created:
             return
 
-        # Commit the current transaction to ensure document is saved
-        frappe.db.commit()
+        # Checkout answers the customer first and queues the site creation in the background
+        if self.flags.defer_site_creation:
+            return
 
-        # Now queue the site creation as a background job
-        frappe.enqueue(
-            "zerp.zerp.server_scripts.site_creation.create_site",
-            queue="long",
-            timeout=1500,
-            subscription_name=self.name,
-            at_front=True  # Put this job at the front of the queue
-        )
+        self.queue_site_creation()
 
         # Show a message to the user
         frappe.msgprint(
@@ -59,209 +97,77 @@ class Subscription(Document):
             indicator='green'
         )
 
+    def queue_site_creation(self):
+        # Commit the current transaction to ensure document is saved
+        frappe.db.commit()
+
+        # Queue the site creation; the provisioning scheduler starts it when capacity allows
+        submit_provisioning(self.name, self.subscription_type)
+
     def onload(self):
         # Add custom button for site deletion
         if self.is_site_created and self.site_url:
             self.set_onload('show_delete_site_button', True)
 
-    @frappe.whitelist()
-    def delete_site(self):
-        """Delete the site associated with this subscription"""
-        try:
-            frappe.flags.ignore_permissions = True
-            
-            if not self.is_site_created or not self.site_url:
-                return {
-                    "success": False,
-                    "message": "No active site found"
-                }
+        # Progress of a queued or running site deletion
+        teardown = get_teardown_status(self.name)
+        if teardown and teardown["status"] != "Completed":
+            self.set_onload('teardown', teardown)
 
-            # Get settings for MySQL and Cloudflare
-            settings = frappe.get_single("Zerp Settings")
-            mysql_password = settings.mysql_root_password
-            cloudflare_token = settings.cloudflare_token
-            zone_id = settings.cloudflare_zone_id
+        # Offer a retry when provisioning failed part way
+        if not self.is_site_created and frappe.db.exists(
+            "Site Provisioning", {"subscription": self.name, "status": "Failed"}
+        ):
+            self.set_onload('show_retry_provisioning_button', True)
 
-            # Extract site name from URL
-            site_name = self.site_url.replace("https://", "").replace("http://", "")
+        # Latest entries of the provisioning and teardown runs
+        self.set_onload('provisioning_log', get_recent_logs(self.name))
 
-            # Delete Cloudflare DNS record
-            try:
-                import requests
-                headers = {
-                    "Authorization": f"Bearer {cloudflare_token}",
-                    "Content-Type": "application/json"
-                }
+    @frappe.whitelist()
+    def retry_provisioning(self):
+        """Resume site creation from the first step that did not complete"""
+        frappe.only_for("System Manager")
 
-                # First, get the DNS record ID
-                list_records_url = f"https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records"
-                params = {"name": site_name}
-                response = requests.get(list_records_url, headers=headers, params=params)
-                response_data = response.json()
+        if self.is_site_created:
+            frappe.throw("The site of this subscription has already been created")
 
-                if response_data["success"] and response_data["result"]:
-                    # Delete each matching DNS record
-                    for record in response_data["result"]:
-                        record_id = record["id"]
-                        delete_url = f"https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records/{record_id}"
-                        delete_response = requests.delete(delete_url, headers=headers)
-                        
-                        if not delete_response.json()["success"]:
-                            frappe.log_error(
-                                message=f"Failed to delete Cloudflare DNS record: {delete_response.text}",
-                                title="Cloudflare DNS Deletion Error"
-                            )
-                            
-                frappe.log_error(
-                    message=f"Cloudflare DNS records deletion attempt completed for {site_name}",
-                    title="Cloudflare DNS Deletion"
-                )
-                
-            except Exception as cf_error:
-                frappe.log_error(
-                    message=f"Error deleting Cloudflare DNS record: {str(cf_error)}",
-                    title="Cloudflare DNS Deletion Error"
-                )
-            
-            # Get bench path and execute drop-site command
-            bench_path = get_bench_path()
-            process = subprocess.Popen(
-                [
-                    "bench", "drop-site",
-                    site_name,
-                    "--force",
-                    "--mariadb-root-password", mysql_password
-                ],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                cwd=bench_path
-            )
-            
-            stdout, stderr = process.communicate(timeout=300)
-            
-            if process.returncode == 0:
-                # Update subscription status
-                self.status = "Cancelled"
-                self.add_comment("Comment", f"Site {site_name} and its DNS records were deleted")
-                self.save(ignore_permissions=True)
-                frappe.db.commit()
-                
-                return {
-                    "success": True,
-                    "message": "Site and DNS records deleted successfully"
-                }
-            else:
-                raise Exception(f"Site deletion failed: {stderr.decode()}")
-                
-        except Exception as e:
-            frappe.log_error(
-                message=f"Site deletion failed: {str(e)}",
-                title="Site Deletion Error"
-            )
+        submit_provisioning(self.name, self.subscription_type)
+        return {
+            "success": True,
+            "message": "Site creation has been queued and will resume from the failed step"
+        }
+
+    @frappe.whitelist()
+    def delete_site(self):
+        """Queue the deletion of the site associated with this subscription"""
+        if not self.is_site_created or not self.site_url:
             return {
                 "success": False,
-                "message": str(e)
+                "message": "No active site found"
             }
 
+        submit_teardown(self.name, "Deletion")
+        return {
+            "success": True,
+            "message": "Deletion of the site and its DNS records has been queued"
+        }
+
     @frappe.whitelist()
     def cancel_subscription(self):
-        """Cancel subscription and drop the associated site"""
-        frappe.flags.ignore_permissions = True
-        try:
-            # Ensure we're running with full permissions
-            if not hasattr(frappe.local, 'no_permission_check'):
-                frappe.local.no_permission_check = True
-            
-            # Check if site is created
-            if not self.is_site_created or not self.site_url:
-                return {
-                    "success": False,
-                    "message": "No active site found for this subscription"
-                }
-            
-            # Get settings for MySQL password
-            settings = frappe.get_single("Zerp Settings")
-            if not settings or not settings.mysql_root_password:
-                return {
-                    "success": False,
-                    "message": "System configuration error: MySQL root password not found"
-                }
-            
-            # Extract site name from URL
-            site_name = self.site_url.replace("https://", "").replace("http://", "")
-            
-            # Log the cancellation attempt
-            frappe.log_error(
-                message=f"Starting site deletion for subscription {self.name}",
-                title="Site Deletion Start"
-            )
-            
-            try:
-                # Get bench path
-                bench_path = get_bench_path()
-                
-                # Execute bench drop-site command
-                process = subprocess.Popen(
-                    [
-                        "bench", "drop-site",
-                        site_name,
-                        "--force",
-                        "--mariadb-root-password", settings.mysql_root_password
-                    ],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    cwd=bench_path
-                )
-                
-                # Wait for process to complete with timeout
-                try:
-                    stdout, stderr = process.communicate(timeout=300)  # 5 minutes timeout
-                    
-                    # Log the output
-                    log_message = f"""Site Deletion Output:
-                    STDOUT: {stdout.decode()}
-                    STDERR: {stderr.decode()}
-                    Return Code: {process.returncode}
-                    """
-                    frappe.log_error(message=log_message, title="Site Deletion Output")
-                    
-                    if process.returncode != 0:
-                        raise Exception(f"Site deletion failed: {stderr.decode()}")
-                    
-                except subprocess.TimeoutExpired:
-                    process.kill()
-                    stdout, stderr = process.communicate()
-                    raise Exception("Site deletion timed out after 300 seconds")
-                
-            except Exception as e:
-                frappe.log_error(
-                    message=f"Error during site deletion: {str(e)}",
-                    title="Site Deletion Error"
-                )
-                raise
-            
-            # Update subscription status
-            self.status = "Cancelled"
-            self.add_comment(
-                "Comment",
-                f"Subscription cancelled and site {site_name} was deleted"
-            )
-            self.save(ignore_permissions=True)
-            
-            # Commit the transaction
-            frappe.db.commit()
-            
-            return {
-                "success": True,
-                "message": "Subscription cancelled successfully"
-            }
-            
-        except Exception as e:
-            frappe.log_error(
-                message=f"Subscription cancellation failed: {str(e)}\n{frappe.get_traceback()}",
-                title="Subscription Cancellation Error"
-            )
+        """Cancel subscription and queue the deletion of the associated site"""
+        if not self.is_site_created or not self.site_url:
             return {
                 "success": False,
-                "message": str(e)
-            }
\ No newline at end of file
+                "message": "No active site found for this subscription"
+            }
+
+        submit_teardown(self.name, "Cancellation")
+        return {
+            "success": True,
+            "message": "Cancellation has been queued, the subscription is cancelled once its site is deleted"
+        }
+
+
+def on_doctype_update():
+    # Serves the keyset pagination of a user's subscriptions
+    frappe.db.add_index("Subscription", ["user", "creation"])
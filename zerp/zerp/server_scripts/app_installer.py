@@ -0,0 +1,81 @@
+import json
+import os
+import sys
+import time
+
+import frappe
+
+REPORT_MARKER = "ZERP_APP_INSTALL "
+
+
+def get_install_apps_command(site_name, apps):
+    """Return a command, run from the bench directory, that installs all apps in one Frappe process
+
+    `bench execute` can not be used, it resolves the method through the apps
+    installed on the site and zerp is not installed on tenant sites.
+    """
+    return [
+        "env/bin/python", "-m", "zerp.zerp.server_scripts.app_installer",
+        site_name, *apps
+    ]
+
+
+def install_apps(apps):
+    """Install apps one after another on the current site.
+
+    Meant to be run through get_install_apps_command, so the interpreter,
+    Frappe imports and database connection are shared by all apps. A report
+    line is printed per app with its duration and outcome.
+    """
+    from frappe.installer import install_app
+
+    for app in apps:
+        start = time.monotonic()
+        try:
+            install_app(app, set_as_patched=True)
+            frappe.db.commit()
+        except Exception as e:
+            frappe.db.rollback()
+            print_report(app, "Failed", start, error=str(e))
+            raise
+
+        print_report(app, "Installed", start)
+
+
+def print_report(app, status, start, error=None):
+    report = {
+        "app": app,
+        "status": status,
+        "duration": round(time.monotonic() - start, 2)
+    }
+    if error:
+        report["error"] = error
+
+    print(REPORT_MARKER + json.dumps(report), flush=True)
+
+
+def parse_install_report(output):
+    """Return the per-app report entries printed by install_apps"""
+    reports = []
+    for line in (output or "").splitlines():
+        if line.startswith(REPORT_MARKER):
+            try:
+                reports.append(json.loads(line[len(REPORT_MARKER):]))
+            except ValueError:
+                continue
+    return reports
+
+
+def main(site, apps):
+    """Connect to the site the way bench commands do and install the apps"""
+    os.chdir("sites")
+    frappe.init(site=site, sites_path=".")
+    frappe.connect()
+    try:
+        install_apps(apps)
+    finally:
+        frappe.destroy()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,109 @@
+import os
+
+import frappe
+from frappe.utils import get_bench_path, now_datetime
+
+# Subscriptions in these states no longer occupy a slot on their host
+RELEASED_STATUSES = ("Cancelled",)
+
+
+def get_host(bench_host=None):
+    """Return the bench path and server IP sites of a bench host live on.
+
+    Without a host, or while no Bench Host is registered, this is the bench
+    Zerp itself runs on.
+    """
+    server_ip = frappe.db.get_single_value("Zerp Settings", "server_ip")
+    if not bench_host:
+        return frappe._dict({
+            "name": None,
+            "bench_path": get_bench_path(),
+            "server_ip": server_ip,
+            "max_concurrent_provisioning": 0
+        })
+
+    host = frappe.db.get_value(
+        "Bench Host",
+        bench_host,
+        ["name", "bench_path", "server_ip", "max_concurrent_provisioning"],
+        as_dict=True
+    )
+    if not host:
+        frappe.throw(f"Bench Host {bench_host} not found")
+
+    host.server_ip = host.server_ip or server_ip
+    return host
+
+
+def is_local_bench(host):
+    """Whether the host is the bench Zerp runs on, where pooled sites and snapshots are kept"""
+    return os.path.abspath(host.bench_path) == os.path.abspath(get_bench_path())
+
+
+def select_bench_host():
+    """Pick the least loaded active host with free capacity and take a slot on it.
+
+    Returns None while no Bench Host is registered, sites then stay on the
+    local bench. Must run in the transaction that saves the subscription.
+    """
+    if not frappe.db.count("Bench Host"):
+        return None
+
+    # Lock the candidates so concurrent placements see each other's slots
+    hosts = frappe.db.sql(
+        """
+        select name from `tabBench Host`
+        where status = 'Active' and tenant_count < capacity
+        order by tenant_count / capacity asc, tenant_count asc, creation asc
+        for update
+        """
+    )
+    if not hosts:
+        frappe.throw("No bench host has free capacity for a new site")
+
+    host_name = hosts[0][0]
+    frappe.db.sql(
+        "update `tabBench Host` set tenant_count = tenant_count + 1 where name = %s",
+        host_name
+    )
+    return host_name
+
+
+def refresh_tenant_count(bench_host):
+    """Recount the subscriptions placed on a host, e.g. after a site was dropped"""
+    if not bench_host:
+        return
+
+    tenant_count = frappe.db.count("Subscription", {
+        "bench_host": bench_host,
+        "status": ["not in", RELEASED_STATUSES]
+    })
+    frappe.db.set_value("Bench Host", bench_host, "tenant_count", tenant_count, update_modified=False)
+
+
+def check_bench_hosts():
+    """Mark hosts whose bench directory is unusable as Unhealthy, and back to Active once fixed"""
+    for host in frappe.get_all("Bench Host", fields=["name", "bench_path", "status"]):
+        error = get_health_error(host.bench_path)
+
+        values = {
+            "last_health_check": now_datetime(),
+            "health_error": error
+        }
+        if error and host.status == "Active":
+            values["status"] = "Unhealthy"
+        elif not error and host.status == "Unhealthy":
+            values["status"] = "Active"
+
+        frappe.db.set_value("Bench Host", host.name, values, update_modified=False)
+        refresh_tenant_count(host.name)
+
+    frappe.db.commit()
+
+
+def get_health_error(bench_path):
+    for path in ("apps", "sites", os.path.join("sites", "common_site_config.json")):
+        if not os.path.exists(os.path.join(bench_path, path)):
+            return f"{os.path.join(bench_path, path)} does not exist"
+
+    return None
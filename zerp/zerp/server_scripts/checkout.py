@@ -0,0 +1,42 @@
+import frappe
+
+from zerp.zerp.server_scripts.stripe_gateway import get_client
+
+# Days of the free trial every new subscription starts with
+TRIAL_DAYS = 14
+
+
+def get_idempotency_key(*parts):
+    """Stripe idempotency key of a checkout step, so a retried request never creates twice"""
+    return "zerp-" + "-".join(str(part) for part in parts)
+
+
+def queue_checkout_followup(subscription_name, customer_id, payment_method_id, update_default_payment_method):
+    frappe.enqueue(
+        "zerp.zerp.server_scripts.checkout.complete_checkout",
+        queue="short",
+        enqueue_after_commit=True,
+        subscription_name=subscription_name,
+        customer_id=customer_id,
+        payment_method_id=payment_method_id,
+        update_default_payment_method=update_default_payment_method
+    )
+
+
+def complete_checkout(subscription_name, customer_id, payment_method_id, update_default_payment_method):
+    """Do the work of a checkout that does not decide its payment outcome"""
+    subscription_doc = frappe.get_doc("Subscription", subscription_name)
+
+    # Future invoices of the customer's other subscriptions use the new card too
+    if update_default_payment_method:
+        try:
+            get_client().customers.update(
+                customer_id,
+                params={"invoice_settings": {"default_payment_method": payment_method_id}},
+                options={"idempotency_key": get_idempotency_key("default-card", customer_id, payment_method_id)}
+            )
+        except Exception:
+            frappe.log_error(frappe.get_traceback(), "Stripe Default Payment Method Error")
+
+    if not subscription_doc.is_site_created:
+        subscription_doc.queue_site_creation()
@@ -0,0 +1,182 @@
+import random
+import time
+
+import frappe
+import requests
+from requests.adapters import HTTPAdapter
+
+API_URL = "https://api.cloudflare.com/client/v4"
+
+# Connect and read timeouts of a single request
+TIMEOUT = (5, 15)
+
+# Upper bound on the time one API call may take including all retries,
+# so a slow Cloudflare never holds a worker for long
+MAX_CALL_SECONDS = 60
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 1
+BACKOFF_MAX = 20
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Cloudflare error code for a record that already exists
+DUPLICATE_RECORD_CODE = 81057
+
+# Comment set on the records Zerp creates, marks them as owned by Zerp
+MANAGED_COMMENT = "zerp-managed"
+
+# Largest number of changes sent in one batch request
+MAX_BATCH_CHANGES = 200
+
+_session = None
+
+
+class CloudflareError(Exception):
+    def __init__(self, message, errors=None, status_code=None):
+        super().__init__(message)
+        self.errors = errors or []
+        self.status_code = status_code
+
+    def has_code(self, code):
+        return any(error.get('code') == code for error in self.errors)
+
+
+def get_session():
+    """Return the keep-alive session shared by all Cloudflare calls of this process"""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        # Retries are handled by CloudflareClient.request so Retry-After is honoured
+        _session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0))
+    return _session
+
+
+def get_client(settings=None):
+    """Return a client for the zone configured in Zerp Settings, or None if Cloudflare is off"""
+    settings = settings or frappe.get_single("Zerp Settings")
+    if not (getattr(settings, 'use_cloudflare', 0) and settings.cloudflare_api_token and settings.cloudflare_zone_id):
+        return None
+
+    return CloudflareClient(settings.cloudflare_api_token, settings.cloudflare_zone_id)
+
+
+def get_site_record(subdomain, server_ip):
+    """Return the proxied A record Zerp keeps for a tenant subdomain"""
+    return {
+        "type": "A",
+        "name": subdomain,
+        "content": server_ip,
+        "ttl": 1,
+        "proxied": True,
+        "comment": MANAGED_COMMENT
+    }
+
+
+class CloudflareClient:
+    def __init__(self, api_token, zone_id):
+        self.zone_id = zone_id
+        self.calls = 0
+        self.headers = {
+            "Authorization": f"Bearer {api_token}",
+            "Content-Type": "application/json"
+        }
+
+    def request(self, method, path, **kwargs):
+        """Call the API, retrying rate limits, server errors and network failures with backoff"""
+        url = f"{API_URL}/zones/{self.zone_id}{path}"
+        deadline = time.monotonic() + MAX_CALL_SECONDS
+
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            retry_after = None
+            self.calls += 1
+            try:
+                response = get_session().request(
+                    method, url, headers=self.headers, timeout=TIMEOUT, **kwargs
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = CloudflareError(f"Cloudflare {method} {path} failed: {e}")
+            else:
+                if response.status_code not in RETRY_STATUS_CODES:
+                    return self.parse_response(method, path, response)
+
+                error = CloudflareError(
+                    f"Cloudflare {method} {path} returned {response.status_code}",
+                    status_code=response.status_code
+                )
+                retry_after = response.headers.get("Retry-After")
+
+            delay = get_retry_delay(attempt, retry_after)
+            if attempt == MAX_ATTEMPTS or time.monotonic() + delay > deadline:
+                raise error
+
+            time.sleep(delay)
+
+    def parse_response(self, method, path, response):
+        try:
+            data = response.json()
+        except ValueError:
+            raise CloudflareError(
+                f"Cloudflare {method} {path} returned {response.status_code} without JSON",
+                status_code=response.status_code
+            )
+
+        if not data.get('success'):
+            raise CloudflareError(
+                f"Cloudflare {method} {path} failed: {data.get('errors')}",
+                errors=data.get('errors'),
+                status_code=response.status_code
+            )
+
+        return data.get('result')
+
+    def list_dns_records(self, **filters):
+        """Return all DNS records matching the filters, following pagination"""
+        records = []
+        page = 1
+        while True:
+            result = self.request(
+                "GET", "/dns_records",
+                params=dict(filters, page=page, per_page=5000)
+            )
+            records.extend(result or [])
+            if not result or len(result) < 5000:
+                return records
+            page += 1
+
+    def create_dns_record(self, record):
+        return self.request("POST", "/dns_records", json=record)
+
+    def batch_dns_records(self, posts=None, patches=None, deletes=None):
+        """Apply several record changes in one API call; Cloudflare runs them as one transaction"""
+        payload = {}
+        if deletes:
+            payload["deletes"] = [{"id": record_id} for record_id in deletes]
+        if patches:
+            payload["patches"] = patches
+        if posts:
+            payload["posts"] = posts
+
+        if not payload:
+            return {}
+
+        return self.request("POST", "/dns_records/batch", json=payload)
+
+    def delete_dns_records(self, name):
+        """Delete every record of a host name; returns the number of records deleted"""
+        records = self.list_dns_records(name=name)
+        self.batch_dns_records(deletes=[record['id'] for record in records])
+        return len(records)
+
+
+
+def get_retry_delay(attempt, retry_after=None):
+    """Seconds to wait before the next attempt, Retry-After takes precedence"""
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+
+    # Exponential backoff with jitter so concurrent workers do not retry in lockstep
+    delay = min(BACKOFF_BASE * 2 ** (attempt - 1), BACKOFF_MAX)
+    return delay / 2 + random.uniform(0, delay / 2)
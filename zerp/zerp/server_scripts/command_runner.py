@@ -0,0 +1,145 @@
+import os
+import re
+import subprocess
+import threading
+import time
+from collections import deque
+
+import frappe
+
+LOG_DIRECTORY = "provisioning_logs"
+MAX_LOG_BYTES = 5 * 1024 * 1024
+TAIL_LINES = 40
+READ_CHUNK_BYTES = 64 * 1024
+
+# Arguments whose following value must never be written to a log
+SECRET_ARGUMENTS = ("--mariadb-root-password", "--admin-password", "--db-password", "set-admin-password")
+
+RUN_ID_PATTERN = re.compile(r"^[\w.-]+$")
+
+
+def new_run_id(prefix):
+    """Return a unique id used to group the output of one provisioning run"""
+    return f"{frappe.scrub(prefix)}-{frappe.generate_hash(length=10)}"
+
+
+def get_log_path(run_id):
+    if not RUN_ID_PATTERN.match(run_id or ""):
+        frappe.throw("Invalid provisioning run id")
+
+    return os.path.abspath(frappe.get_site_path("private", LOG_DIRECTORY, f"{run_id}.log"))
+
+
+def mask_command(command):
+    """Return the command as a string with secrets replaced by asterisks"""
+    masked = []
+    hide_next = False
+    for part in command:
+        masked.append("********" if hide_next else str(part))
+        hide_next = part in SECRET_ARGUMENTS
+    return " ".join(masked)
+
+
+def run_command(command, cwd, run_id, timeout=600, keep_prefix=None, input_text="\n", env=None):
+    """Run a command, streaming its output line by line into the run's log file.
+
+    The log file is capped at MAX_LOG_BYTES per run and only the last
+    TAIL_LINES lines are kept in memory, so memory stays flat however much
+    the command prints. Lines starting with keep_prefix are kept in full.
+    Secrets for the command go in env, which is never logged.
+    """
+    log_path = get_log_path(run_id)
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+
+    tail = deque(maxlen=TAIL_LINES)
+    kept = []
+    state = {"timed_out": False}
+    start = time.monotonic()
+
+    with open(log_path, "a") as log:
+        written = log.tell()
+        log.write(f"$ {mask_command(command)}\n")
+        log.flush()
+
+        process = subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            stdin=subprocess.PIPE,  # Answer a possible prompt instead of blocking
+            universal_newlines=True,
+            bufsize=1,
+            cwd=cwd,
+            env=dict(os.environ, **env) if env else None
+        )
+
+        try:
+            process.stdin.write(input_text)
+            process.stdin.close()
+        except OSError:
+            pass
+
+        def kill():
+            state["timed_out"] = True
+            process.kill()
+
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+
+        try:
+            for line in process.stdout:
+                line = line.rstrip("\n")
+                tail.append(line)
+
+                if keep_prefix and line.startswith(keep_prefix):
+                    kept.append(line)
+
+                if written < MAX_LOG_BYTES:
+                    log.write(line + "\n")
+                    written += len(line) + 1
+                    if written >= MAX_LOG_BYTES:
+                        log.write("... log size limit reached, further output is not stored ...\n")
+
+            process.wait()
+        finally:
+            timer.cancel()
+            process.stdout.close()
+
+        duration = round(time.monotonic() - start, 2)
+        if state["timed_out"]:
+            log.write(f"Command timed out after {timeout} seconds\n")
+        log.write(f"Return Code: {process.returncode} ({duration}s)\n")
+
+    return frappe._dict({
+        "returncode": process.returncode,
+        "output": "\n".join(tail),
+        "kept": kept,
+        "timed_out": state["timed_out"],
+        "duration": duration,
+        "run_id": run_id,
+        "log_path": log_path
+    })
+
+
+@frappe.whitelist()
+def read_log(run_id, offset=0, length=READ_CHUNK_BYTES):
+    """Read a provisioning log incrementally, starting at a byte offset"""
+    frappe.only_for("System Manager")
+
+    log_path = get_log_path(run_id)
+    if not os.path.exists(log_path):
+        frappe.throw(f"Provisioning log {run_id} not found")
+
+    offset = max(int(offset), 0)
+    length = min(max(int(length), 1), READ_CHUNK_BYTES)
+    size = os.path.getsize(log_path)
+
+    with open(log_path, "rb") as log:
+        log.seek(offset)
+        data = log.read(length)
+
+    return {
+        "data": data.decode("utf-8", errors="replace"),
+        "offset": offset + len(data),
+        "size": size,
+        "eof": offset + len(data) >= size
+    }
@@ -0,0 +1,177 @@
+import json
+import time
+
+import frappe
+from frappe.utils import cint
+
+from zerp.zerp.server_scripts.cloudflare import (
+    MANAGED_COMMENT,
+    MAX_BATCH_CHANGES,
+    get_client,
+    get_site_record,
+)
+
+# Pause between batch requests to stay well below the API rate limit
+BATCH_PAUSE_SECONDS = 1
+DEFAULT_MAX_DELETES = 50
+
+# Names under the base domain that are never treated as tenant records
+PROTECTED_SUBDOMAINS = ("www", "mail", "api")
+
+
+def reconcile_dns():
+    """Compare the Cloudflare zone with the active sites and fix the difference.
+
+    One zone listing and one query load both sides; creates, updates and
+    deletes are then sent in batches, so a run costs a few API calls
+    however many tenants there are.
+    """
+    settings = frappe.get_single("Zerp Settings")
+    client = get_client(settings)
+    if not client or not settings.base_domain:
+        return None
+
+    report = frappe.get_doc({
+        "doctype": "DNS Reconciliation",
+        "status": "Running",
+        "dry_run": cint(settings.dns_reconcile_dry_run)
+    }).insert(ignore_permissions=True)
+    frappe.db.commit()
+
+    try:
+        expected = get_expected_records(settings)
+        records = client.list_dns_records(type="A")
+        drift = get_drift(expected, records, settings)
+
+        max_deletes = cint(settings.dns_max_deletes) or DEFAULT_MAX_DELETES
+        if len(drift["deletes"]) > max_deletes:
+            # Too many at once points to a problem on our side, never mass delete
+            for entry in drift["report"]:
+                if entry["action"] == "delete":
+                    entry["action"] = "delete skipped"
+            drift["deletes"] = []
+
+        applied = {"posts": 0, "patches": 0, "deletes": 0}
+        if not report.dry_run:
+            applied = apply_changes(client, drift)
+
+        report.db_set({
+            "status": "Completed",
+            "api_calls": client.calls,
+            "zone_records": len(records),
+            "expected_records": len(expected),
+            "missing_count": drift["missing"],
+            "mismatched_count": drift["mismatched"],
+            "orphaned_count": drift["orphaned"],
+            "created": applied["posts"],
+            "updated": applied["patches"],
+            "deleted": applied["deletes"],
+            "drift": json.dumps(drift["report"], indent=1)
+        })
+        frappe.db.commit()
+
+    except Exception as e:
+        report.db_set({"status": "Failed", "api_calls": client.calls, "error": str(e)[:1000]})
+        frappe.db.commit()
+        frappe.log_error(frappe.get_traceback(), "DNS Reconciliation Error")
+
+    return report.name
+
+
+def get_expected_records(settings):
+    """Return {fqdn: (subdomain, server_ip)} for every site that should resolve"""
+    subscriptions = frappe.db.sql(
+        """
+        select s.sub_domain, h.server_ip
+        from `tabSubscription` s
+        left join `tabBench Host` h on h.name = s.bench_host
+        where s.is_site_created = 1 and s.status != 'Cancelled'
+        """,
+        as_dict=True
+    )
+    return {
+        f"{row.sub_domain}.{settings.base_domain}": (row.sub_domain, row.server_ip or settings.server_ip)
+        for row in subscriptions
+    }
+
+
+def get_server_ips(settings):
+    """Return every IP tenant records of Zerp point to"""
+    ips = set(frappe.get_all("Bench Host", filters={"server_ip": ["is", "set"]}, pluck="server_ip"))
+    if settings.server_ip:
+        ips.add(settings.server_ip)
+    return ips
+
+
+def is_tenant_name(name, base_domain):
+    subdomain, _, domain = name.partition(".")
+    return domain == base_domain and subdomain not in PROTECTED_SUBDOMAINS
+
+
+def get_drift(expected, records, settings):
+    """Return the changes that make the zone match the expected records"""
+    server_ips = get_server_ips(settings)
+    drift = {"posts": [], "patches": [], "deletes": [], "report": [], "missing": 0, "mismatched": 0, "orphaned": 0}
+    found = set()
+
+    for record in records:
+        name = record["name"]
+        if not is_tenant_name(name, settings.base_domain):
+            continue
+
+        # Only records Zerp tagged are deleted, anything created by hand is left alone
+        managed = record.get("comment") == MANAGED_COMMENT
+
+        if name in expected and name not in found:
+            found.add(name)
+            server_ip = expected[name][1]
+            if record["content"] != server_ip:
+                drift["patches"].append({"id": record["id"], "content": server_ip, "comment": MANAGED_COMMENT})
+                drift["mismatched"] += 1
+                drift["report"].append({"name": name, "action": "update", "content": record["content"], "expected": server_ip})
+        elif managed:
+            drift["deletes"].append(record["id"])
+            drift["orphaned"] += 1
+            drift["report"].append({"name": name, "action": "delete", "content": record["content"]})
+        elif record["content"] in server_ips:
+            # Likely a tenant record from before tagging, reported for a manual check
+            drift["report"].append({"name": name, "action": "untagged", "content": record["content"]})
+
+    for name, (subdomain, server_ip) in expected.items():
+        if name not in found:
+            drift["posts"].append(get_site_record(subdomain, server_ip))
+            drift["missing"] += 1
+            drift["report"].append({"name": name, "action": "create", "expected": server_ip})
+
+    return drift
+
+
+def apply_changes(client, drift):
+    """Send the changes in batches of at most MAX_BATCH_CHANGES"""
+    changes = (
+        [("deletes", record_id) for record_id in drift["deletes"]]
+        + [("patches", patch) for patch in drift["patches"]]
+        + [("posts", post) for post in drift["posts"]]
+    )
+    applied = {"posts": 0, "patches": 0, "deletes": 0}
+
+    for start in range(0, len(changes), MAX_BATCH_CHANGES):
+        if start:
+            time.sleep(BATCH_PAUSE_SECONDS)
+
+        batch = {"posts": [], "patches": [], "deletes": []}
+        for kind, change in changes[start:start + MAX_BATCH_CHANGES]:
+            batch[kind].append(change)
+
+        client.batch_dns_records(**batch)
+        for kind in applied:
+            applied[kind] += len(batch[kind])
+
+    return applied
+
+
+@frappe.whitelist()
+def run_dns_reconciliation():
+    frappe.only_for("System Manager")
+    frappe.enqueue("zerp.zerp.server_scripts.dns_reconciler.reconcile_dns", queue="long", timeout=1500)
+    return {"success": True, "message": "DNS reconciliation has been queued"}
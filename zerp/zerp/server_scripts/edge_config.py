@@ -0,0 +1,143 @@
+import time
+
+import frappe
+from frappe.utils import cint
+from frappe.utils.synchronization import filelock
+
+from zerp.zerp.server_scripts.bench_hosts import get_host
+from zerp.zerp.server_scripts.nginx_sites import is_per_site_mode, remove_site_config, write_site_config
+from zerp.zerp.server_scripts.provisioning_log import RunLog
+
+# Generation counters kept in redis per bench host: every site creation or
+# deletion bumps the requested generation, the worker records the generation
+# it applied.
+REQUESTED_KEY = "zerp_edge_config_requested"
+APPLIED_KEY = "zerp_edge_config_applied"
+FAILED_KEY = "zerp_edge_config_failed"
+ERROR_KEY = "zerp_edge_config_error"
+SCHEDULED_KEY = "zerp_edge_config_scheduled"
+
+DEFAULT_RELOAD_WINDOW = 5
+WAIT_POLL_INTERVAL = 2
+
+# The scheduled marker outlives the reload window by this much; if its worker
+# died, the next request or waiting caller schedules a new one
+SCHEDULED_GRACE_SECONDS = 60
+
+
+def get_key(key, bench_host=None):
+    return frappe.cache().make_key(f"{key}:{bench_host}" if bench_host else key)
+
+
+def get_counter(key, bench_host=None):
+    return cint(frappe.cache().get(get_key(key, bench_host)))
+
+
+def request_edge_config_update(bench_host=None):
+    """Mark the nginx config of a bench host dirty and make sure a reload is scheduled.
+
+    Returns the generation a caller can pass to wait_for_edge_config.
+    """
+    generation = frappe.cache().incr(get_key(REQUESTED_KEY, bench_host))
+    schedule_edge_config(bench_host)
+    return generation
+
+
+def schedule_edge_config(bench_host=None):
+    """Enqueue a reload worker unless one is already pending for the host"""
+    window = cint(frappe.db.get_single_value("Zerp Settings", "nginx_reload_window")) or DEFAULT_RELOAD_WINDOW
+
+    # Only one pending worker per host; it picks up every request made before it runs
+    if frappe.cache().set(get_key(SCHEDULED_KEY, bench_host), 1, nx=True, ex=window + SCHEDULED_GRACE_SECONDS):
+        frappe.enqueue(
+            "zerp.zerp.server_scripts.edge_config.apply_edge_config",
+            queue="default",
+            timeout=900,
+            bench_host=bench_host
+        )
+
+
+def request_site_addition(site_name, bench_host=None):
+    """Add the site to the nginx config of its host and schedule a reload"""
+    if is_per_site_mode():
+        write_site_config(site_name, bench_path=get_host(bench_host).bench_path)
+
+    return request_edge_config_update(bench_host)
+
+
+def request_site_removal(site_name, bench_host=None):
+    """Remove the site from the nginx config of its host and schedule a reload"""
+    remove_site_config(site_name, bench_path=get_host(bench_host).bench_path)
+    return request_edge_config_update(bench_host)
+
+
+def get_reload_steps(settings):
+    if is_per_site_mode(settings):
+        # Site server blocks are already in place, nginx only needs a reload
+        return [
+            {
+                'name': 'Validate Nginx Config',
+                'command': ["sudo", "nginx", "-t"]
+            },
+            {
+                'name': 'Reload Nginx',
+                'command': ["sudo", "service", "nginx", "reload"]
+            }
+        ]
+
+    return [
+        {
+            'name': 'Nginx Setup',
+            'command': ["bench", "setup", "nginx", "--yes"]
+        },
+        {
+            'name': 'Reload Nginx',
+            'command': ["sudo", "service", "nginx", "reload"]
+        }
+    ]
+
+
+def apply_edge_config(bench_host=None):
+    """Regenerate or validate, then reload nginx once for all requests of the debounce window"""
+    from zerp.zerp.server_scripts.site_creation import execute_steps
+
+    settings = frappe.get_single("Zerp Settings")
+    time.sleep(cint(settings.nginx_reload_window) or DEFAULT_RELOAD_WINDOW)
+
+    # Requests arriving from now on schedule a new worker
+    cache = frappe.cache()
+    cache.delete(get_key(SCHEDULED_KEY, bench_host))
+    target = get_counter(REQUESTED_KEY, bench_host)
+
+    # Hosts reload independently, only workers of the same host wait for each other
+    with filelock(f"zerp_edge_config_{frappe.scrub(bench_host or 'local')}", timeout=900, is_global=True):
+        if target <= get_counter(APPLIED_KEY, bench_host):
+            return
+
+        try:
+            execute_steps(get_reload_steps(settings), get_host(bench_host).bench_path, RunLog())
+        except Exception as e:
+            cache.set(get_key(ERROR_KEY, bench_host), str(e))
+            cache.set(get_key(FAILED_KEY, bench_host), target)
+            raise
+
+        cache.set(get_key(APPLIED_KEY, bench_host), target)
+
+
+def wait_for_edge_config(generation, bench_host=None, timeout=900):
+    """Block until the nginx reload covering the given generation is done"""
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        if get_counter(APPLIED_KEY, bench_host) >= generation:
+            return
+
+        if get_counter(FAILED_KEY, bench_host) >= generation:
+            error = frappe.cache().get(get_key(ERROR_KEY, bench_host))
+            raise Exception(f"Nginx reload failed: {frappe.safe_decode(error)}")
+
+        # A no-op while a worker is pending, replaces one that died otherwise
+        schedule_edge_config(bench_host)
+        time.sleep(WAIT_POLL_INTERVAL)
+
+    raise Exception(f"Timed out after {timeout} seconds waiting for nginx reload")
@@ -0,0 +1,145 @@
+import os
+import subprocess
+
+import frappe
+from frappe.utils import get_bench_path
+
+PER_SITE_MODE = "Per Site Include"
+
+# Mirrors the server block bench generates per site; the upstreams are the
+# ones defined in the bench's own nginx.conf.
+SITE_SERVER_BLOCK = """server {{
+	listen 80;
+	server_name {site_name};
+	root {sites_path};
+
+	proxy_buffer_size 128k;
+	proxy_buffers 4 256k;
+	proxy_busy_buffers_size 256k;
+
+	add_header X-Frame-Options "SAMEORIGIN";
+	add_header X-Content-Type-Options nosniff;
+	add_header X-XSS-Protection "1; mode=block";
+	add_header Referrer-Policy "same-origin, strict-origin-when-cross-origin";
+
+	location /assets {{
+		try_files $uri =404;
+		add_header Cache-Control "max-age=31536000";
+	}}
+
+	location ~ ^/protected/(.*) {{
+		internal;
+		try_files /{site_name}/$1 =404;
+	}}
+
+	location /socket.io {{
+		proxy_http_version 1.1;
+		proxy_set_header Upgrade $http_upgrade;
+		proxy_set_header Connection "upgrade";
+		proxy_set_header X-Frappe-Site-Name {site_name};
+		proxy_set_header Origin $scheme://$http_host;
+		proxy_set_header Host $host;
+		proxy_pass http://{bench_name}-socketio-server;
+	}}
+
+	location / {{
+		rewrite ^(.+)/$ $1 permanent;
+		rewrite ^(.+)/index\\.html$ $1 permanent;
+		rewrite ^(.+)\\.html$ $1 permanent;
+
+		location ~* ^/files/.*.(htm|html|svg|xml) {{
+			add_header Content-disposition "attachment";
+			try_files /{site_name}/public/$uri @webserver;
+		}}
+
+		try_files /{site_name}/public/$uri @webserver;
+	}}
+
+	location @webserver {{
+		proxy_http_version 1.1;
+		proxy_set_header X-Forwarded-For $remote_addr;
+		proxy_set_header X-Forwarded-Proto $scheme;
+		proxy_set_header X-Frappe-Site-Name {site_name};
+		proxy_set_header Host $host;
+		proxy_set_header X-Use-X-Accel-Redirect True;
+		proxy_read_timeout 120;
+		proxy_redirect off;
+		proxy_pass http://{bench_name}-frappe;
+	}}
+
+	client_max_body_size 50m;
+}}
+"""
+
+
+def is_per_site_mode(settings=None):
+    settings = settings or frappe.get_single("Zerp Settings")
+    return settings.nginx_config_mode == PER_SITE_MODE
+
+
+def get_sites_directory(settings=None, bench_path=None):
+    """Return the directory holding one nginx include file per tenant site.
+
+    The main nginx config has to include `<directory>/*.conf` once.
+    """
+    settings = settings or frappe.get_single("Zerp Settings")
+    bench_path = bench_path or get_bench_path()
+    return settings.nginx_sites_directory or os.path.join(bench_path, "config", "nginx-sites")
+
+
+def get_site_config_path(site_name, settings=None, bench_path=None):
+    return os.path.join(get_sites_directory(settings, bench_path), f"{site_name}.conf")
+
+
+def write_site_config(site_name, settings=None, bench_path=None):
+    """Write the server block of a single site and validate it with nginx -t.
+
+    The file is removed again if nginx rejects the configuration, so a broken
+    site never blocks reloads for the others.
+    """
+    bench_path = bench_path or get_bench_path()
+    config_path = get_site_config_path(site_name, settings, bench_path)
+    os.makedirs(os.path.dirname(config_path), exist_ok=True)
+
+    content = SITE_SERVER_BLOCK.format(
+        site_name=site_name,
+        sites_path=os.path.join(bench_path, "sites"),
+        bench_name=os.path.basename(os.path.abspath(bench_path))
+    )
+
+    # Write atomically so a concurrent nginx -t never reads a partial file
+    temp_path = f"{config_path}.tmp"
+    with open(temp_path, "w") as f:
+        f.write(content)
+    os.replace(temp_path, config_path)
+
+    error = validate_nginx_config()
+    if error:
+        os.remove(config_path)
+        raise Exception(f"Nginx rejected the configuration for {site_name}: {error}")
+
+    return config_path
+
+
+def remove_site_config(site_name, settings=None, bench_path=None):
+    """Remove the server block of a dropped site; returns True if a file was removed"""
+    config_path = get_site_config_path(site_name, settings, bench_path)
+    if not os.path.exists(config_path):
+        return False
+
+    os.remove(config_path)
+    return True
+
+
+def validate_nginx_config():
+    """Run nginx -t and return its error output, or None if the config is valid"""
+    result = subprocess.run(
+        ["sudo", "nginx", "-t"],
+        capture_output=True,
+        text=True,
+        timeout=60
+    )
+    if result.returncode != 0:
+        return result.stderr or result.stdout
+
+    return None
@@ -0,0 +1,50 @@
+from collections import defaultdict
+
+import frappe
+
+# Plans with their apps as shown on the public pages, cleared on every plan change
+CATALOG_KEY = "zerp_plan_catalog"
+
+
+def get_plan_catalog():
+    """Return the enabled plans, cheapest first, each with the list of its apps"""
+    return frappe.cache().get_value(CATALOG_KEY, generator=build_plan_catalog)
+
+
+def build_plan_catalog():
+    filters = {}
+    if frappe.get_meta("Subscription Plan").has_field("enabled"):
+        filters["enabled"] = 1
+
+    plans = frappe.get_all(
+        "Subscription Plan",
+        fields=["name", "plan_name", "plan_monthly_subscription", "plan_description"],
+        filters=filters,
+        order_by="plan_monthly_subscription asc"
+    )
+    if not plans:
+        return []
+
+    apps = defaultdict(list)
+    for row in frappe.get_all(
+        "Subscription Plan App",
+        fields=["parent", "app_name"],
+        filters={"parenttype": "Subscription Plan", "parent": ["in", [plan.name for plan in plans]]},
+        order_by="idx asc"
+    ):
+        apps[row.parent].append({"app_name": row.app_name})
+
+    return [
+        {
+            "name": plan.name,
+            "plan_name": plan.plan_name,
+            "plan_monthly_subscription": plan.plan_monthly_subscription,
+            "plan_description": plan.plan_description,
+            "apps": apps[plan.name]
+        }
+        for plan in plans
+    ]
+
+
+def clear_plan_catalog(doc=None, method=None):
+    frappe.cache().delete_value(CATALOG_KEY)
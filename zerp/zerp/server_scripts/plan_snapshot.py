@@ -0,0 +1,260 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+
+import frappe
+from frappe.utils import get_bench_path, now_datetime
+
+from zerp.zerp.server_scripts.provisioning_log import RunLog
+
+SNAPSHOT_DIRECTORY = "zerp_snapshots"
+
+
+def is_snapshot_enabled(settings=None):
+    settings = settings or frappe.get_single("Zerp Settings")
+    return bool(getattr(settings, 'use_plan_snapshots', 0))
+
+
+def get_app_version(app, bench_path):
+    """Return the version string and git commit of an app on this bench"""
+    try:
+        version = getattr(frappe.get_module(app), "__version__", "")
+    except ImportError:
+        version = ""
+
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.join(bench_path, "apps", app),
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+            timeout=10
+        ).strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ""
+
+    return version, commit
+
+
+def get_apps_fingerprint(apps, bench_path=None):
+    """Hash the app list and the installed version of every app in it.
+
+    Any app upgrade or change of the plan's app list yields a new fingerprint.
+    """
+    bench_path = bench_path or get_bench_path()
+    versions = [
+        [app, *get_app_version(app, bench_path)]
+        for app in ["frappe", *apps]
+    ]
+    return hashlib.sha1(json.dumps(versions).encode()).hexdigest()
+
+
+def get_snapshot_path(snapshot_name):
+    """Return the directory of one snapshot build.
+
+    Keyed by the snapshot, not the fingerprint: plans with the same apps
+    must not share files one of them may delete on its next rebuild.
+    """
+    return os.path.abspath(frappe.get_site_path("private", SNAPSHOT_DIRECTORY, snapshot_name))
+
+
+def get_ready_snapshot(plan, apps, bench_path=None):
+    """Return the ready snapshot of the plan matching the current app versions"""
+    snapshot = frappe.db.get_value(
+        "Plan Snapshot",
+        {
+            "plan": plan,
+            "fingerprint": get_apps_fingerprint(apps, bench_path),
+            "status": "Ready"
+        },
+        ["name", "database_path", "files_path"],
+        as_dict=True
+    )
+    # Files removed by hand make the site a fresh install instead of a failed one
+    if snapshot and snapshot.database_path and os.path.exists(snapshot.database_path):
+        return snapshot
+    return None
+
+
+def is_snapshot_in_use(snapshot_name):
+    """Whether an unfinished provisioning run may still restore from the snapshot"""
+    return bool(frappe.db.exists(
+        "Site Provisioning", {"snapshot": snapshot_name, "status": ["!=", "Completed"]}
+    ))
+
+
+def remove_obsolete_snapshot_files():
+    """Delete the files of obsolete snapshots once no unfinished provisioning run needs them"""
+    for snapshot_name in frappe.get_all("Plan Snapshot", filters={"status": "Obsolete"}, pluck="name"):
+        snapshot_path = get_snapshot_path(snapshot_name)
+        if os.path.exists(snapshot_path) and not is_snapshot_in_use(snapshot_name):
+            shutil.rmtree(snapshot_path, ignore_errors=True)
+
+
+def get_snapshot_restore_steps(snapshot, site_name, settings, admin_password):
+    """Return the steps that create a site from a golden snapshot"""
+    new_site_command = [
+        "bench", "new-site", site_name,
+        "--source_sql", snapshot.database_path,
+        "--admin-password", admin_password,
+        "--mariadb-root-password", settings.mysql_root_password
+    ]
+    steps = [
+        {
+            'key': 'new_site',
+            'name': 'New Site From Snapshot',
+            'command': new_site_command,
+            'retry_command': new_site_command + ["--force"]
+        },
+        {
+            'key': 'reset_admin_password',
+            'name': 'Reset Administrator Password',
+            'command': ["bench", "--site", site_name, "set-admin-password", admin_password]
+        }
+    ]
+
+    if snapshot.files_path and os.path.exists(snapshot.files_path):
+        steps.append({
+            'key': 'restore_snapshot_files',
+            'name': 'Restore Snapshot Files',
+            'command': ["tar", "-xzf", snapshot.files_path, "-C", f"sites/{site_name}"]
+        })
+
+    return steps
+
+
+def on_plan_update(doc, method=None):
+    """Rebuild the plan's snapshot when its app list changed"""
+    if is_snapshot_enabled():
+        enqueue_snapshot_build(doc.name)
+
+
+def refresh_plan_snapshots():
+    """Rebuild snapshots of plans whose apps were upgraded on the bench"""
+    remove_obsolete_snapshot_files()
+
+    if not is_snapshot_enabled():
+        return
+
+    for plan in frappe.get_all("Subscription Plan", pluck="name"):
+        enqueue_snapshot_build(plan)
+
+
+def enqueue_snapshot_build(plan):
+    apps = [app.app_name for app in frappe.get_doc("Subscription Plan", plan).plan_apps]
+    fingerprint = get_apps_fingerprint(apps)
+
+    if frappe.db.exists("Plan Snapshot", {
+        "plan": plan,
+        "fingerprint": fingerprint,
+        "status": ["in", ["Building", "Ready"]]
+    }):
+        return
+
+    snapshot = frappe.get_doc({
+        "doctype": "Plan Snapshot",
+        "plan": plan,
+        "fingerprint": fingerprint,
+        "apps": ",".join(apps),
+        "status": "Building"
+    }).insert(ignore_permissions=True)
+
+    frappe.enqueue(
+        "zerp.zerp.server_scripts.plan_snapshot.build_plan_snapshot",
+        queue="long",
+        timeout=3000,
+        snapshot_name=snapshot.name,
+        enqueue_after_commit=True
+    )
+
+
+def build_plan_snapshot(snapshot_name):
+    """Install the plan's apps on a template site and store its database and files"""
+    from zerp.zerp.server_scripts.site_creation import execute_steps, get_site_creation_steps
+
+    snapshot = frappe.get_doc("Plan Snapshot", snapshot_name)
+    settings = frappe.get_single("Zerp Settings")
+    bench_path = get_bench_path()
+    # One template site per build, so concurrent builds never collide
+    template_site = f"zerp-snapshot-{snapshot.name.lower()}.local"
+    snapshot_path = get_snapshot_path(snapshot.name)
+    database_path = os.path.join(snapshot_path, "database.sql.gz")
+    files_path = os.path.join(snapshot_path, "files.tar.gz")
+
+    try:
+        os.makedirs(snapshot_path, exist_ok=True)
+
+        steps = get_site_creation_steps(
+            template_site,
+            snapshot.apps.split(",") if snapshot.apps else [],
+            settings
+        )
+        steps.extend([
+            {
+                'name': 'Backup Template Database',
+                'command': [
+                    "bench", "--site", template_site, "backup",
+                    "--backup-path-db", database_path
+                ]
+            },
+            {
+                'name': 'Archive Template Files',
+                'command': [
+                    "tar", "-czf", files_path,
+                    "-C", f"sites/{template_site}",
+                    "public/files", "private/files"
+                ]
+            }
+        ])
+        execute_steps(steps, bench_path, RunLog())
+
+        snapshot.db_set({
+            "status": "Ready",
+            "database_path": database_path,
+            "files_path": files_path,
+            "built_on": now_datetime()
+        })
+
+        # Older snapshots of the plan are superseded by this one
+        for previous in frappe.get_all(
+            "Plan Snapshot",
+            filters={"plan": snapshot.plan, "status": "Ready", "name": ["!=", snapshot.name]},
+            pluck="name"
+        ):
+            frappe.db.set_value("Plan Snapshot", previous, "status", "Obsolete")
+
+        frappe.db.commit()
+        remove_obsolete_snapshot_files()
+
+    except Exception as e:
+        snapshot.db_set({
+            "status": "Failed",
+            "error": f"{str(e)}\n{frappe.get_traceback()}"
+        })
+        frappe.db.commit()
+        frappe.log_error(
+            message=f"Snapshot build failed for plan {snapshot.plan}: {str(e)}",
+            title="Plan Snapshot Error"
+        )
+
+    finally:
+        drop_template_site(template_site, settings, bench_path)
+
+
+def drop_template_site(template_site, settings, bench_path):
+    if not os.path.exists(os.path.join(bench_path, "sites", template_site)):
+        return
+
+    subprocess.run(
+        [
+            "bench", "drop-site", template_site,
+            "--force", "--no-backup",
+            "--mariadb-root-password", settings.mysql_root_password
+        ],
+        cwd=bench_path,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        timeout=600
+    )
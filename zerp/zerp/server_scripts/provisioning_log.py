@@ -0,0 +1,88 @@
+import frappe
+from frappe.utils import now_datetime
+
+LOG_FIELDS = [
+    "name", "creation", "modified", "owner", "modified_by",
+    "run_id", "subscription", "reference_doctype", "reference_name",
+    "level", "step", "logged_at", "message"
+]
+
+# Entries shown on the Subscription form
+RECENT_LIMIT = 30
+
+
+class RunLog(list):
+    """Messages of one provisioning, teardown or pool run.
+
+    Behaves like the list of messages it replaces; entries are also kept
+    with their level and step and written to Provisioning Log in one insert
+    per flush. A log without a reference is never stored.
+    """
+
+    def __init__(self, subscription=None, reference=None):
+        super().__init__()
+        self.subscription = subscription
+        self.reference_doctype = None
+        self.reference_name = None
+        self.run_id = None
+        self.step = None
+        self.pending = []
+        if reference:
+            self.set_reference(reference)
+
+    def set_reference(self, doc):
+        """Group the entries under a run record that has a run_id"""
+        self.reference_doctype = doc.doctype
+        self.reference_name = doc.name
+        self.run_id = doc.get("run_id")
+        self.subscription = self.subscription or doc.get("subscription")
+
+    def append(self, message, level="Info"):
+        super().append(message)
+        self.pending.append((level, self.step, now_datetime(), message))
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def warning(self, message):
+        self.append(message, "Warning")
+
+    def error(self, message):
+        self.append(message, "Error")
+
+    def flush(self):
+        """Write the entries added since the last flush"""
+        if not self.pending or not self.reference_name:
+            return
+
+        pending, self.pending = self.pending, []
+        now = now_datetime()
+        try:
+            frappe.db.bulk_insert(
+                "Provisioning Log",
+                LOG_FIELDS,
+                [
+                    (
+                        frappe.generate_hash(length=10), now, now, frappe.session.user, frappe.session.user,
+                        self.run_id, self.subscription, self.reference_doctype, self.reference_name,
+                        level, step, logged_at, message
+                    )
+                    for level, step, logged_at, message in pending
+                ]
+            )
+            frappe.db.commit()
+        except Exception:
+            # Losing log lines must never fail the run they describe
+            frappe.log_error(frappe.get_traceback(), "Provisioning Log Error")
+
+
+def get_recent_logs(subscription, limit=RECENT_LIMIT):
+    """Return the latest log entries of a subscription, newest first"""
+    return frappe.get_all(
+        "Provisioning Log",
+        filters={"subscription": subscription},
+        fields=["run_id", "reference_doctype", "level", "step", "logged_at", "message"],
+        order_by="logged_at desc",
+        limit=limit
+    )
@@ -0,0 +1,191 @@
+import shutil
+
+import frappe
+from frappe.utils import add_to_date, cint, flt, now_datetime
+
+from zerp.zerp.doctype.site_provisioning.site_provisioning import get_provisioning
+from zerp.zerp.server_scripts.bench_hosts import get_host
+from zerp.zerp.server_scripts.run_queue import (
+    dispatch_runs,
+    get_running_counts,
+    requeue_stalled_runs,
+    start_run,
+    take_slot,
+)
+
+# Lower runs first; paying customers are provisioned before trials
+PRIORITY_CLASSES = {
+    "Paid": 10,
+    "Trial": 20
+}
+DEFAULT_PRIORITY = 30
+
+# Waiting longer than this lifts a run into the top class so trials never starve
+PRIORITY_AGING_MINUTES = 30
+
+DEFAULT_MAX_CONCURRENT = 2
+
+DISPATCH_LOCK = "zerp_provisioning_dispatch"
+SUBMIT_LOCK = "zerp_provisioning_submit"
+ADMISSION_KEY = "zerp_provisioning_admission"
+
+
+def submit_provisioning(subscription_name, subscription_type=None):
+    """Queue site creation for the subscription and dispatch what capacity allows.
+
+    Checkout and the subscription webhook both call this; whichever comes
+    second finds the run queued, running or done and changes nothing.
+    """
+    cache = frappe.cache()
+    with cache.lock(cache.make_key(f"{SUBMIT_LOCK}:{subscription_name}"), timeout=60):
+        subscription = frappe.db.get_value(
+            "Subscription", subscription_name, ["is_site_created", "bench_host"], as_dict=True
+        )
+        if not subscription or subscription.is_site_created:
+            return None
+
+        provisioning = get_provisioning(subscription_name)
+        if provisioning.status in ("Queued", "Running"):
+            return provisioning.name
+
+        provisioning.db_set({
+            "status": "Queued",
+            "bench_host": subscription.bench_host,
+            "priority": PRIORITY_CLASSES.get(subscription_type, DEFAULT_PRIORITY),
+            "queued_at": now_datetime()
+        })
+        frappe.db.commit()
+
+    dispatch_provisioning()
+    return provisioning.name
+
+
+def dispatch_provisioning():
+    """Start queued provisioning runs on every bench host with free slots and resources"""
+    dispatch_runs(DISPATCH_LOCK, _dispatch)
+
+
+def _dispatch():
+    queued = get_queued_provisioning()
+    if not queued:
+        return
+
+    settings = frappe.get_single("Zerp Settings")
+    running = get_running_counts("Site Provisioning")
+    hosts = {}
+    refusals = {}
+
+    for provisioning in queued:
+        bench_host = provisioning.bench_host or None
+        if bench_host not in hosts:
+            hosts[bench_host] = get_host(bench_host)
+            refusals[bench_host] = check_admission(settings, hosts[bench_host])
+
+        if refusals[bench_host]:
+            continue
+
+        if not take_slot(running, bench_host, get_max_concurrent(settings, hosts[bench_host])):
+            continue
+
+        start_run(
+            "Site Provisioning",
+            provisioning.name,
+            "zerp.zerp.server_scripts.site_creation.create_site",
+            subscription_name=provisioning.subscription
+        )
+
+    frappe.cache().set_value(
+        ADMISSION_KEY,
+        {(bench_host or "local"): reasons for bench_host, reasons in refusals.items() if reasons},
+        expires_in_sec=600
+    )
+
+
+def get_max_concurrent(settings, host):
+    return (
+        cint(host.max_concurrent_provisioning)
+        or cint(settings.max_concurrent_provisioning)
+        or DEFAULT_MAX_CONCURRENT
+    )
+
+
+def requeue_stalled_provisioning():
+    """Requeue provisioning runs whose worker died without recording an outcome"""
+    requeue_stalled_runs("Site Provisioning", dispatch_provisioning)
+
+
+def get_queued_provisioning():
+    """Return queued runs by priority class, oldest first within a class"""
+    queued = frappe.get_all(
+        "Site Provisioning",
+        filters={"status": "Queued"},
+        fields=["name", "subscription", "bench_host", "priority", "queued_at"],
+        order_by="queued_at asc",
+        limit=200
+    )
+
+    aged_before = add_to_date(now_datetime(), minutes=-PRIORITY_AGING_MINUTES)
+
+    def sort_key(provisioning):
+        queued_at = provisioning.queued_at or now_datetime()
+        priority = 0 if queued_at < aged_before else cint(provisioning.priority)
+        return (priority, queued_at)
+
+    return sorted(queued, key=sort_key)
+
+
+def check_admission(settings, host):
+    """Return the reasons the bench host cannot take another site right now, if any"""
+    refusals = []
+
+    min_free_disk_gb = flt(settings.min_free_disk_gb)
+    if min_free_disk_gb:
+        free_disk_gb = shutil.disk_usage(host.bench_path).free / 1024 ** 3
+        if free_disk_gb < min_free_disk_gb:
+            refusals.append(f"Free disk {free_disk_gb:.1f} GB is below {min_free_disk_gb} GB")
+
+    min_free_memory_mb = cint(settings.min_free_memory_mb)
+    if min_free_memory_mb:
+        free_memory_mb = get_available_memory_mb()
+        if free_memory_mb is not None and free_memory_mb < min_free_memory_mb:
+            refusals.append(f"Available memory {free_memory_mb} MB is below {min_free_memory_mb} MB")
+
+    max_db_threads_running = cint(settings.max_db_threads_running)
+    if max_db_threads_running:
+        threads_running = get_db_threads_running()
+        if threads_running > max_db_threads_running:
+            refusals.append(
+                f"Database has {threads_running} running threads, limit is {max_db_threads_running}"
+            )
+
+    return refusals
+
+
+def get_available_memory_mb():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return cint(line.split()[1]) // 1024
+    except OSError:
+        return None
+
+
+def get_db_threads_running():
+    result = frappe.db.sql("show global status like 'Threads_running'")
+    return cint(result[0][1]) if result else 0
+
+
+@frappe.whitelist()
+def get_scheduler_status():
+    """Summarise the provisioning queue for the desk"""
+    frappe.only_for("System Manager")
+
+    settings = frappe.get_single("Zerp Settings")
+    running = get_running_counts("Site Provisioning")
+    return {
+        "max_concurrent": cint(settings.max_concurrent_provisioning) or DEFAULT_MAX_CONCURRENT,
+        "running": {(bench_host or "local"): count for bench_host, count in running.items()},
+        "queued": frappe.db.count("Site Provisioning", {"status": "Queued"}),
+        "admission_refusals": frappe.cache().get_value(ADMISSION_KEY) or {}
+    }
@@ -0,0 +1,30 @@
+import frappe
+from frappe.website.utils import clear_cache
+
+# Guest facing pages served from the website cache
+PUBLIC_ROUTES = ("index", "cshome", "subscribe")
+
+
+def refresh_public_pages(doc=None, method=None):
+    """Drop the cached pages after a plan or the settings changed and render them again"""
+    for route in PUBLIC_ROUTES:
+        clear_cache(route)
+
+    frappe.enqueue(
+        "zerp.zerp.server_scripts.public_pages.render_public_pages",
+        queue="short",
+        enqueue_after_commit=True
+    )
+
+
+def render_public_pages():
+    """Render the pages as a guest so the first visitor after a change gets them from the cache"""
+    from frappe.website.serve import get_response_content
+
+    frappe.set_user("Guest")
+    frappe.local.form_dict = frappe._dict()
+    for route in PUBLIC_ROUTES:
+        try:
+            get_response_content(route)
+        except Exception:
+            frappe.log_error(frappe.get_traceback(), f"Public Page Render Error: {route}")
@@ -0,0 +1,80 @@
+import frappe
+from frappe.utils import add_to_date, now_datetime
+from redis.exceptions import LockError
+
+# Shared by the provisioning and teardown schedulers: runs are queued records
+# with a status, started under a concurrency cap by a dispatcher that holds a
+# redis lock, and requeued when their worker died.
+
+# Jobs run with this timeout, a run still Running well after it is stalled
+JOB_TIMEOUT = 1500
+STALLED_AFTER_MINUTES = 60
+
+
+def dispatch_runs(lock_name, dispatch):
+    """Call dispatch under a redis lock; when another dispatcher holds it, that one picks up the queue"""
+    cache = frappe.cache()
+    try:
+        with cache.lock(cache.make_key(lock_name), timeout=60, blocking_timeout=5):
+            dispatch()
+    except LockError:
+        pass
+
+
+def dispatch_after_run(dispatch, title):
+    """Start the next queued run once a finished one freed its slot; never fails the finished run"""
+    try:
+        dispatch()
+    except Exception:
+        frappe.log_error(frappe.get_traceback(), title)
+
+
+def get_running_counts(doctype):
+    """Return the number of running runs of the doctype per bench host"""
+    rows = frappe.db.sql(
+        f"""
+        select bench_host, count(*) from `tab{doctype}`
+        where status = 'Running'
+        group by bench_host
+        """
+    )
+    return {(bench_host or None): count for bench_host, count in rows}
+
+
+def take_slot(running, key, max_concurrent):
+    """Count one more run under key if it is below the cap; returns whether a slot was free"""
+    if running.get(key, 0) >= max_concurrent:
+        return False
+
+    # Counted as running from now on so concurrent dispatchers respect the cap
+    running[key] = running.get(key, 0) + 1
+    return True
+
+
+def start_run(doctype, name, method, **kwargs):
+    """Mark a queued run Running and enqueue its job"""
+    frappe.db.set_value(doctype, name, "status", "Running")
+    frappe.db.commit()
+
+    frappe.enqueue(method, queue="long", timeout=JOB_TIMEOUT, **kwargs)
+
+
+def requeue_stalled_runs(doctype, dispatch):
+    """Requeue runs whose worker died without recording an outcome, then dispatch"""
+    stalled = frappe.get_all(
+        doctype,
+        filters={
+            "status": "Running",
+            "modified": ["<", add_to_date(now_datetime(), minutes=-STALLED_AFTER_MINUTES)]
+        },
+        pluck="name"
+    )
+
+    for name in stalled:
+        frappe.db.set_value(doctype, name, {
+            "status": "Queued",
+            "queued_at": now_datetime()
+        })
+
+    frappe.db.commit()
+    dispatch()
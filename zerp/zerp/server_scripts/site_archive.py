@@ -0,0 +1,277 @@
+import hashlib
+import json
+import os
+import shutil
+
+import frappe
+from frappe.utils import add_days, cint, now_datetime, nowdate
+
+from zerp.zerp.server_scripts.bench_hosts import get_host
+from zerp.zerp.server_scripts.command_runner import new_run_id, run_command
+from zerp.zerp.server_scripts.time_windows import is_within_hours
+
+STAGING_DIRECTORY = "zerp_staging"
+OBJECTS_DIRECTORY = "objects"
+DATABASE_DUMP = "database.sql"
+
+# Archives handled per scheduler run, the rest waits for the next hour
+MAX_ARCHIVES_PER_RUN = 20
+
+# Failed archives are retried in later windows up to this many attempts,
+# then expire after the retention period like archived ones
+MAX_ATTEMPTS = 3
+
+# Background compression must not compete with live tenants for CPU and disk
+LOW_PRIORITY = ["nice", "-n", "19", "ionice", "-c", "3"]
+
+HASH_CHUNK_BYTES = 1024 * 1024
+
+
+def is_fast_purge_enabled(settings=None):
+    settings = settings or frappe.get_single("Zerp Settings")
+    return bool(getattr(settings, 'fast_purge_teardown', 0))
+
+
+def get_archive_root(bench_path, settings=None):
+    settings = settings or frappe.get_single("Zerp Settings")
+    return settings.archive_directory or os.path.join(bench_path, "archived_sites", "zerp")
+
+
+def get_staging_path(bench_path, teardown_name):
+    """Return the staging folder of one teardown; it must be on the filesystem of the bench"""
+    return os.path.join(bench_path, "archived_sites", STAGING_DIRECTORY, teardown_name)
+
+
+def get_fast_purge_steps(teardown, settings, host):
+    """Return the steps that detach a site quickly, leaving compression to the archive window"""
+    site_name = teardown.site_name
+    staging_path = get_staging_path(host.bench_path, teardown.name)
+    dump_path = os.path.join(staging_path, DATABASE_DUMP)
+
+    return [
+        {
+            'key': 'dump_database',
+            'name': 'Dump Database',
+            'function': lambda: dump_site_database(host.bench_path, site_name, dump_path, teardown.run_id),
+            'is_done': lambda: os.path.exists(dump_path)
+        },
+        {
+            'key': 'drop_site',
+            'name': 'Drop Site',
+            # Without a backup drop-site only drops the database and moves the folder
+            'command': [
+                "bench", "drop-site", site_name,
+                "--force",
+                "--no-backup",
+                "--archived-sites-path", staging_path,
+                "--mariadb-root-password", settings.mysql_root_password
+            ],
+            'is_done': lambda: not os.path.exists(os.path.join(host.bench_path, "sites", site_name))
+        },
+        {
+            'key': 'stage_archive',
+            'name': 'Stage Archive',
+            'function': lambda: stage_site_archive(teardown, staging_path),
+            'is_done': lambda: bool(frappe.db.exists("Site Archive", {"teardown": teardown.name}))
+        }
+    ]
+
+
+def dump_site_database(bench_path, site_name, dump_path, run_id):
+    """Dump the site database uncompressed with the site's own credentials"""
+    site_path = os.path.join(bench_path, "sites")
+    config = {}
+    for config_path in (
+        os.path.join(site_path, "common_site_config.json"),
+        os.path.join(site_path, site_name, "site_config.json")
+    ):
+        with open(config_path) as f:
+            config.update(json.load(f))
+
+    os.makedirs(os.path.dirname(dump_path), exist_ok=True)
+    temp_path = f"{dump_path}.tmp"
+
+    result = run_command(
+        [
+            "mysqldump",
+            "--single-transaction",
+            "--quick",
+            "--routines",
+            "--host", config.get("db_host") or "localhost",
+            "--port", str(config.get("db_port") or 3306),
+            "--user", config.get("db_user") or config["db_name"],
+            "--result-file", temp_path,
+            config["db_name"]
+        ],
+        bench_path,
+        run_id,
+        env={"MYSQL_PWD": config["db_password"]}
+    )
+    if result.returncode != 0:
+        raise Exception(f"Database dump of {site_name} failed: {result.output}")
+
+    # Only a complete dump counts, so a retry never drops the site after a partial one
+    os.replace(temp_path, dump_path)
+
+
+def stage_site_archive(teardown, staging_path):
+    frappe.get_doc({
+        "doctype": "Site Archive",
+        "subscription": teardown.subscription,
+        "site_name": teardown.site_name,
+        "bench_host": teardown.bench_host,
+        "teardown": teardown.name,
+        "status": "Staged",
+        "staging_path": staging_path
+    }).insert(ignore_permissions=True)
+
+
+def process_site_archives(force=False):
+    """Compress staged archives and delete expired ones inside the archive window"""
+    settings = frappe.get_single("Zerp Settings")
+    if not force and not is_within_hours(settings.archive_window_start_hour, settings.archive_window_end_hour):
+        return
+
+    expire_site_archives(settings)
+
+    pending = frappe.db.sql(
+        """
+        select name from `tabSite Archive`
+        where status = 'Staged' or (status = 'Failed' and attempts < %s)
+        order by creation asc
+        limit %s
+        """,
+        (MAX_ATTEMPTS, MAX_ARCHIVES_PER_RUN)
+    )
+    for (archive_name,) in pending:
+        compress_site_archive(archive_name, settings)
+
+
+def compress_site_archive(archive_name, settings):
+    """Move a staged archive into the archive store, compressing the dump and sharing identical files"""
+    archive = frappe.get_doc("Site Archive", archive_name)
+    archive.db_set("status", "Compressing")
+    frappe.db.commit()
+
+    try:
+        bench_path = get_host(archive.bench_host).bench_path
+        archive_root = get_archive_root(bench_path, settings)
+        archive_path = os.path.join(archive_root, archive.teardown)
+
+        dump_path = os.path.join(archive.staging_path, DATABASE_DUMP)
+        if os.path.exists(dump_path):
+            result = run_command(
+                LOW_PRIORITY + ["gzip", "-f", dump_path],
+                bench_path,
+                new_run_id(f"archive-{archive.name}")
+            )
+            if result.returncode != 0:
+                raise Exception(f"Compressing {dump_path} failed: {result.output}")
+
+        os.makedirs(archive_root, exist_ok=True)
+        if os.path.exists(archive.staging_path):
+            # A copy left by a failed move to another filesystem; the staged folder is complete
+            if os.path.exists(archive_path):
+                shutil.rmtree(archive_path)
+            shutil.move(archive.staging_path, archive_path)
+
+        size, deduplicated = deduplicate_files(archive_path, os.path.join(archive_root, OBJECTS_DIRECTORY))
+
+        retention_days = cint(settings.archive_retention_days)
+        archive.db_set({
+            "status": "Archived",
+            "archive_path": archive_path,
+            "archived_on": now_datetime(),
+            "expires_on": add_days(nowdate(), retention_days) if retention_days else None,
+            "size_bytes": size,
+            "deduplicated_bytes": deduplicated,
+            "error": None
+        })
+        frappe.db.commit()
+
+    except Exception as e:
+        frappe.db.rollback()
+        attempts = cint(archive.attempts) + 1
+        retention_days = cint(settings.archive_retention_days)
+        archive.db_set({
+            "status": "Failed",
+            "attempts": attempts,
+            "error": str(e),
+            # Given up on, the staged files are removed once the retention period is over
+            "expires_on": add_days(nowdate(), retention_days) if attempts >= MAX_ATTEMPTS and retention_days else None
+        })
+        frappe.db.commit()
+        frappe.log_error(frappe.get_traceback(), "Site Archive Error")
+
+
+def deduplicate_files(archive_path, objects_path):
+    """Replace files already stored by another archive with hard links to one shared copy.
+
+    Every file is linked into a content addressed object store; returns the
+    total size of the archive and the bytes saved by sharing.
+    """
+    size = 0
+    deduplicated = 0
+
+    for directory, _, files in os.walk(archive_path):
+        for filename in files:
+            path = os.path.join(directory, filename)
+            if os.path.islink(path):
+                continue
+
+            stat = os.stat(path)
+            size += stat.st_size
+
+            digest = get_file_hash(path)
+            object_path = os.path.join(objects_path, digest[:2], digest)
+
+            if not os.path.exists(object_path):
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                os.link(path, object_path)
+            elif not os.path.samefile(path, object_path):
+                temp_path = f"{path}.dedup"
+                os.link(object_path, temp_path)
+                os.replace(temp_path, path)
+                deduplicated += stat.st_size
+
+    return size, deduplicated
+
+
+def get_file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def expire_site_archives(settings):
+    """Delete archives past their retention date and the shared files nobody links to anymore"""
+    expired = frappe.get_all(
+        "Site Archive",
+        filters={"status": ["in", ["Archived", "Failed"]], "expires_on": ["<", nowdate()]},
+        fields=["name", "archive_path", "staging_path", "bench_host"]
+    )
+
+    archive_roots = set()
+    for archive in expired:
+        # A failed archive may have been moved part way, both places are cleared
+        for path in (archive.archive_path, archive.staging_path):
+            if path:
+                shutil.rmtree(path, ignore_errors=True)
+        frappe.db.set_value("Site Archive", archive.name, "status", "Expired")
+        archive_roots.add(get_archive_root(get_host(archive.bench_host).bench_path, settings))
+
+    frappe.db.commit()
+
+    for archive_root in archive_roots:
+        remove_unreferenced_objects(os.path.join(archive_root, OBJECTS_DIRECTORY))
+
+
+def remove_unreferenced_objects(objects_path):
+    """Delete stored objects whose only remaining link is the object store itself"""
+    for directory, _, files in os.walk(objects_path):
+        for filename in files:
+            path = os.path.join(directory, filename)
+            if os.stat(path).st_nlink == 1:
+                os.remove(path)
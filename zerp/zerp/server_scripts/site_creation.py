@@ -1,26 +1,86 @@
 import frappe
+import json
 import os
 import subprocess
-import requests
-from frappe.utils import get_bench_path
+from frappe.utils import now_datetime
+from zerp.zerp.server_scripts.app_installer import (
+    REPORT_MARKER,
+    get_install_apps_command,
+    parse_install_report,
+)
+from zerp.zerp.server_scripts.bench_hosts import get_host, is_local_bench
+from zerp.zerp.server_scripts.cloudflare import (
+    DUPLICATE_RECORD_CODE,
+    CloudflareClient,
+    CloudflareError,
+    get_site_record,
+)
+from zerp.zerp.server_scripts.command_runner import mask_command, new_run_id, run_command
+from zerp.zerp.server_scripts.edge_config import request_site_addition, wait_for_edge_config
+from zerp.zerp.server_scripts.plan_snapshot import (
+    get_ready_snapshot,
+    get_snapshot_restore_steps,
+    is_snapshot_enabled,
+)
+from zerp.zerp.doctype.site_provisioning.site_provisioning import get_provisioning
+from zerp.zerp.server_scripts.provisioning_log import RunLog
+from zerp.zerp.server_scripts.provisioning_scheduler import dispatch_provisioning
+from zerp.zerp.server_scripts.run_queue import dispatch_after_run
+from zerp.zerp.server_scripts.site_pool import (
+    claim_pool_site,
+    get_claimed_pool_entry,
+    get_pool_activation_steps,
+    is_pool_enabled,
+    mark_pool_entry_activated,
+)
+
+# Held for the whole run; longer than the job timeout so it never expires under it
+SITE_CREATION_LOCK = "zerp_site_creation"
+SITE_CREATION_LOCK_SECONDS = 1800
 
 def create_site(subscription_name):
-    """Create a new site for the subscription"""
-    log_messages = []
+    """Create a new site for the subscription, unless another worker is already at it
+
+    A run requeued as stalled while its job still waited in a backed-up
+    queue is dispatched a second time; the lock keeps the two apart.
+    """
+    cache = frappe.cache()
+    lock = cache.lock(cache.make_key(f"{SITE_CREATION_LOCK}:{subscription_name}"), timeout=SITE_CREATION_LOCK_SECONDS)
+    if not lock.acquire(blocking=False):
+        return False
+
+    try:
+        return run_site_creation(subscription_name)
+    finally:
+        lock.release()
+
+def run_site_creation(subscription_name):
+    """Create the site of the subscription, resuming its provisioning record"""
+    log_messages = RunLog(subscription=subscription_name)
     subscription_doc = None
+    provisioning = None
 
     try:
         # Ensure clean state
         frappe.db.rollback()
         
         # Log the start
-        start_log = f"Starting site creation process for {subscription_name}"
-        log_messages.append(start_log)
-        frappe.log_error(message=start_log, title="Site Creation Start")
+        log_messages.append(f"Starting site creation process for {subscription_name}")
         
         # Get subscription document
         subscription_doc = frappe.get_doc("Subscription", subscription_name)
         
+        # Checkout and the subscription webhook both trigger provisioning
+        if subscription_doc.is_site_created:
+            # Release the slot of a run whose worker died after creating the site
+            frappe.db.set_value(
+                "Site Provisioning",
+                {"subscription": subscription_name, "status": ["!=", "Completed"]},
+                {"status": "Completed", "completed_at": now_datetime()}
+            )
+            frappe.db.commit()
+            return True
+        
         # Get settings
         settings = frappe.get_single("Zerp Settings")
         if not settings:
@@ -46,142 +106,98 @@ def create_site(subscription_name):
         apps_to_install = [app.app_name for app in plan_apps.plan_apps]
         log_messages.append(f"Apps to install: {apps_to_install}")
         
-        # Get bench path
-        bench_path = get_bench_path()
-        
-        # Site creation steps
-        steps = [
-            {
-                'name': 'New Site Creation',
-                'command': [
-                    "bench", "new-site", site_name,
-                    "--admin-password", "admin",
-                    "--mariadb-root-password", settings.mysql_root_password
-                ]
-            }
-        ]
-        
-        # Add app installation steps
-        for app in apps_to_install:
-            steps.append({
-                'name': f'Install App: {app}',
-                'command': ["bench", "--site", site_name, "install-app", app]
+        # Sites are created on the bench host chosen when the subscription was placed
+        host = get_host(subscription_doc.bench_host)
+        bench_path = host.bench_path
+        log_messages.append(f"Bench host: {host.name or 'local bench'} ({bench_path})")
+        
+        # Resume the unfinished provisioning record of this subscription, if any
+        provisioning = get_provisioning(subscription_name)
+        # Only a run the dispatcher started is worked on; a job left over from
+        # before a requeue finds it Queued, Failed or done and leaves it alone
+        if provisioning.status != "Running":
+            return False
+        log_messages.set_reference(provisioning)
+        log_messages.append(f"Provisioning record: {provisioning.name}, log: {provisioning.run_id}")
+        
+        # Decide where the site comes from; kept as is once a step has completed
+        if not provisioning.site_source or not provisioning.has_completed_steps():
+            pool_entry = get_claimed_pool_entry(subscription_name)
+            # Pooled sites are claimed here only, once the run owns the subscription;
+            # they are kept on the local bench
+            if not pool_entry and is_pool_enabled() and is_local_bench(host):
+                if claim_pool_site(subscription_doc.plan, subscription_name):
+                    pool_entry = get_claimed_pool_entry(subscription_name)
+            snapshot = None
+            # Snapshots are built on the local bench only
+            if not pool_entry and is_snapshot_enabled(settings) and is_local_bench(host):
+                snapshot = get_ready_snapshot(subscription_doc.plan, apps_to_install)
+            
+            provisioning.update({
+                'site_name': site_name,
+                'bench_host': host.name,
+                'site_source': "Pool" if pool_entry else "Snapshot" if snapshot else "Fresh Install",
+                'pool_entry': pool_entry.name if pool_entry else None,
+                'snapshot': snapshot.name if snapshot else None
             })
+            if not provisioning.admin_password:
+                # Pooled sites get fresh credentials, they were installed before the customer existed
+                provisioning.admin_password = frappe.generate_hash(length=12) if pool_entry else "admin"
+            provisioning.save(ignore_permissions=True)
+            frappe.db.commit()
         
-        # Add domain and nginx steps
-        steps.extend([
-            {
-                'name': 'Add Domain',
-                'command': ["bench", "setup", "add-domain", site_name, "--site", site_name]
-            },
-            {
-                'name': 'Nginx Setup',
-                'command': ["bench", "setup", "nginx", "--yes"]
-            },
-            {
-                'name': 'Reload Nginx',
-                'command': ["sudo", "service", "nginx", "reload"]
-            }
-        ])
-        
-        # Execute steps
-        for step in steps:
-            try:
-                # Use Popen with more comprehensive error handling
-                process = subprocess.Popen(
-                    step['command'],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    stdin=subprocess.PIPE,  # Add stdin to prevent potential blocking
-                    universal_newlines=True,  # Use text mode for easier input/output handling
-                    cwd=bench_path
-                )
-                
-                # Attempt to read output without hanging
-                try:
-                    # Use communicate with timeout and input
-                    stdout, stderr = process.communicate(input='\n', timeout=600)  # 10 minutes timeout
-                except subprocess.TimeoutExpired:
-                    # If timeout occurs, kill the process
-                    process.kill()
-                    stdout, stderr = process.communicate()
-                    
-                    # Log detailed timeout information
-                    timeout_log = (
-                        f"Command timed out: {step['command']}\n"
-                        f"STDOUT: {stdout}\n"
-                        f"STDERR: {stderr}"
-                    )
-                    frappe.log_error(message=timeout_log, title=f"Timeout in {step['name']}")
-                    
-                    # Check if process is still running and force kill
-                    if process.poll() is None:
-                        process.terminate()
-                        try:
-                            process.wait(timeout=10)
-                        except subprocess.TimeoutExpired:
-                            process.kill()
-                
-                # Log command output
-                step_log = (
-                    f"{step['name']} Command: {' '.join(step['command'])}\n"
-                    f"STDOUT: {stdout}\n"
-                    f"STDERR: {stderr}\n"
-                    f"Return Code: {process.returncode}"
-                )
-                log_messages.append(step_log)
-                frappe.log_error(message=step_log, title=f"Site Creation Step: {step['name']}")
-                
-                # Check return code
-                if process.returncode != 0:
-                    # Detailed error logging
-                    error_details = (
-                        f"Command failed: {step['command']}\n"
-                        f"Return Code: {process.returncode}\n"
-                        f"STDOUT: {stdout}\n"
-                        f"STDERR: {stderr}"
-                    )
-                    raise Exception(error_details)
-            
-            except Exception as step_error:
-                # Comprehensive error handling
-                error_log = (
-                    f"Step {step['name']} failed: {str(step_error)}\n"
-                    f"Command: {step['command']}"
+        admin_password = provisioning.get_password('admin_password')
+        
+        if provisioning.site_source == "Pool":
+            pool_site_name = frappe.db.get_value("Site Pool Entry", provisioning.pool_entry, "site_name")
+            log_messages.append(f"Using pooled site {pool_site_name} from {provisioning.pool_entry}")
+            steps = get_pool_activation_steps(pool_site_name, site_name, admin_password, bench_path)
+        else:
+            snapshot = None
+            if provisioning.site_source == "Snapshot":
+                snapshot = frappe.db.get_value(
+                    "Plan Snapshot",
+                    provisioning.snapshot,
+                    ["name", "database_path", "files_path"],
+                    as_dict=True
                 )
-                log_messages.append(error_log)
-                frappe.log_error(message=error_log, title=f"Site Creation Step Error: {step['name']}")
-                raise
+            steps = get_site_creation_steps(
+                site_name, apps_to_install, settings, admin_password, snapshot=snapshot
+            )
+        
+        # Add domain step
+        steps.append({
+            'key': 'add_domain',
+            'name': 'Add Domain',
+            'command': ["bench", "setup", "add-domain", site_name, "--site", site_name],
+            'is_done': lambda: site_has_domain(bench_path, site_name, site_name)
+        })
+        
+        # Nginx is regenerated and reloaded once for all concurrent site changes
+        steps.append({
+            'key': 'edge_config',
+            'name': 'Nginx Configuration',
+            'function': lambda: wait_for_edge_config(
+                request_site_addition(site_name, host.name), host.name
+            )
+        })
+        
+        if provisioning.site_source == "Pool":
+            steps.append({
+                'key': 'activate_pool_entry',
+                'name': 'Activate Pool Entry',
+                'function': lambda: mark_pool_entry_activated(provisioning.pool_entry)
+            })
         
         # Cloudflare DNS setup if enabled
-        if getattr(settings, 'use_cloudflare', 0) and settings.cloudflare_api_token and settings.cloudflare_zone_id:
-            try:
-                cloudflare_result = setup_cloudflare_dns(
-                    subdomain=subscription_doc.sub_domain, 
-                    cf_settings={
-                        'api_token': settings.cloudflare_api_token,
-                        'zone_id': settings.cloudflare_zone_id,
-                        'base_domain': settings.base_domain
-                    }
-                )
-                
-                # Log Cloudflare setup details
-                log_messages.append(f"Cloudflare DNS setup result: {cloudflare_result}")
-                
-                # Add Cloudflare log messages to subscription comments
-                for log_msg in cloudflare_result.get('log_messages', []):
-                    subscription_doc.add_comment('Comment', log_msg)
-            
-            except Exception as cf_error:
-                cf_error_log = f"Cloudflare DNS setup failed: {str(cf_error)}"
-                log_messages.append(cf_error_log)
-                frappe.log_error(message=cf_error_log, title="Cloudflare DNS Error")
-                
-                # Optionally, you can choose to continue or stop the process
-                # Here, we'll continue but mark it in the logs
-                subscription_doc.add_comment('Comment', cf_error_log)
-        else:
-            log_messages.append("Cloudflare integration is disabled or not fully configured")
+        steps.append({
+            'key': 'cloudflare_dns',
+            'name': 'Cloudflare DNS',
+            'function': lambda: setup_site_dns(subscription_doc, settings, log_messages, host.server_ip)
+        })
+        
+        # Execute the remaining steps, each one checkpointed on the provisioning record
+        provisioning.run_steps(steps, bench_path, log_messages)
         
         # Update subscription status
         subscription_doc.db_set('is_site_created', 1)
@@ -189,33 +205,176 @@ def create_site(subscription_name):
         subscription_doc.db_set('status', 'Active')
         frappe.db.commit()
         
-        # Add comments with logs
-        for log_message in log_messages:
-            subscription_doc.add_comment('Comment', log_message)
-        
         # Send email notification
-        send_success_email(subscription_doc, site_name)
+        send_success_email(subscription_doc, site_name, admin_password)
         
         # Final success log
-        success_log = f"Site created successfully: {site_name}"
-        log_messages.append(success_log)
-        frappe.log_error(message=success_log, title="Site Creation Success")
+        log_messages.append(f"Site created successfully: {site_name}")
+        
+        provisioning.db_set({'status': 'Completed', 'completed_at': now_datetime()})
+        frappe.db.commit()
+        log_messages.flush()
         
         return True
     
     except Exception as e:
         error_log = f"Site creation failed for {subscription_name}: {str(e)}\n{frappe.get_traceback()}"
         frappe.log_error(message=error_log, title="Site Creation Error")
+        log_messages.error(f"Site creation failed: {str(e)}")
+        
+        # Keep the record so a retry resumes from the failed step
+        if provisioning:
+            provisioning.db_set({'status': 'Failed', 'error': str(e)})
         
         # Update subscription status to reflect failure
         if subscription_doc:
             subscription_doc.db_set('status', 'Draft')
-            subscription_doc.add_comment('Comment', error_log)
             frappe.db.commit()
         
+        log_messages.flush()
         raise
+    
+    finally:
+        dispatch_after_run(dispatch_provisioning, "Provisioning Dispatch Error")
+
+def get_site_creation_steps(site_name, apps_to_install, settings, admin_password="admin", plan=None, snapshot=None):
+    """Return the steps that create a fresh site and install the given apps
 
-def setup_cloudflare_dns(subdomain, cf_settings):
+    When a golden snapshot is given, or the plan has one for the current app
+    versions, the site is restored from it instead of installing every app
+    from scratch.
+    """
+    if not snapshot and plan and is_snapshot_enabled(settings):
+        snapshot = get_ready_snapshot(plan, apps_to_install)
+    
+    if snapshot:
+        return get_snapshot_restore_steps(snapshot, site_name, settings, admin_password)
+
+    new_site_command = [
+        "bench", "new-site", site_name,
+        "--admin-password", admin_password,
+        "--mariadb-root-password", settings.mysql_root_password
+    ]
+    steps = [
+        {
+            'key': 'new_site',
+            'name': 'New Site Creation',
+            'command': new_site_command,
+            # A retry reinstalls over the half-created site of the failed attempt
+            'retry_command': new_site_command + ["--force"]
+        }
+    ]
+    
+    # Install all apps in one bench process unless configured otherwise
+    if apps_to_install and settings.app_install_mode != "Per App Process":
+        steps.append({
+            'key': 'install_apps',
+            'name': f"Install Apps: {', '.join(apps_to_install)}",
+            'command': get_install_apps_command(site_name, apps_to_install),
+            'install_report': True
+        })
+        return steps
+    
+    # Add app installation steps
+    for app in apps_to_install:
+        steps.append({
+            'key': f'install_app:{app}',
+            'name': f'Install App: {app}',
+            'command': ["bench", "--site", site_name, "install-app", app]
+        })
+    
+    return steps
+
+def execute_steps(steps, bench_path, log_messages, run_id=None):
+    """Run the command of each step in order, raising on the first failure
+
+    The full output of every step is streamed into the run's log file, only
+    the last lines of it are kept in log_messages, a RunLog.
+    """
+    run_id = run_id or new_run_id("provisioning")
+    for step in steps:
+        if step.get('function'):
+            step['function']()
+            log_messages.append(f"{step['name']} completed")
+            continue
+        
+        try:
+            result = run_command(
+                step['command'],
+                bench_path,
+                run_id,
+                timeout=600,  # 10 minutes timeout
+                keep_prefix=REPORT_MARKER if step.get('install_report') else None
+            )
+            
+            if result.timed_out:
+                # Log detailed timeout information
+                log_messages.warning(
+                    f"Command timed out: {mask_command(step['command'])}\n"
+                    f"Output (last lines): {result.output}\n"
+                    f"Full log: {run_id}"
+                )
+            
+            # Log command output
+            step_log = (
+                f"{step['name']} Command: {mask_command(step['command'])}\n"
+                f"Output (last lines): {result.output}\n"
+                f"Return Code: {result.returncode} ({result.duration}s)"
+            )
+            log_messages.append(step_log)
+            
+            # Report timing and outcome of each app installed by the step
+            if step.get('install_report'):
+                for report in parse_install_report("\n".join(result.kept)):
+                    log_messages.append(
+                        f"App {report['app']}: {report['status']} in {report['duration']}s"
+                        + (f" - {report['error']}" if report.get('error') else "")
+                    )
+            
+            # Check return code
+            if result.returncode != 0:
+                # Detailed error logging
+                error_details = (
+                    f"Command failed: {mask_command(step['command'])}\n"
+                    f"Return Code: {result.returncode}\n"
+                    f"Output (last lines): {result.output}\n"
+                    f"Full log: {run_id}"
+                )
+                raise Exception(error_details)
+        
+        except Exception as step_error:
+            # Comprehensive error handling
+            log_messages.error(
+                f"Step {step['name']} failed: {str(step_error)}\n"
+                f"Command: {mask_command(step['command'])}"
+            )
+            raise
+
+def setup_site_dns(subscription_doc, settings, log_messages, server_ip=None):
+    """Create the Cloudflare DNS record of the site if Cloudflare is enabled"""
+    if getattr(settings, 'use_cloudflare', 0) and settings.cloudflare_api_token and settings.cloudflare_zone_id:
+        try:
+            cloudflare_result = setup_cloudflare_dns(
+                subdomain=subscription_doc.sub_domain, 
+                cf_settings={
+                    'api_token': settings.cloudflare_api_token,
+                    'zone_id': settings.cloudflare_zone_id,
+                    'base_domain': settings.base_domain
+                },
+                server_ip=server_ip
+            )
+    
+            # Log Cloudflare setup details
+            log_messages.append(f"Cloudflare DNS setup result: {cloudflare_result.get('message')}")
+            log_messages.extend(cloudflare_result.get('log_messages', []))
+    
+        except Exception as cf_error:
+            # Continue without the record, setup_cloudflare_dns already logged the error
+            log_messages.error(f"Cloudflare DNS setup failed: {str(cf_error)}")
+    else:
+        log_messages.append("Cloudflare integration is disabled or not fully configured")
+
+def setup_cloudflare_dns(subdomain, cf_settings, server_ip=None):
     """Setup Cloudflare DNS record with extensive logging"""
     # Extensive logging setup
     log_messages = []
@@ -225,9 +384,10 @@ def setup_cloudflare_dns(subdomain, cf_settings):
         if not all([subdomain, cf_settings.get('api_token'), cf_settings.get('zone_id')]):
             raise ValueError("Missing required Cloudflare configuration parameters")
         
-        # Get server IP 
-        settings = frappe.get_single("Zerp Settings")
-        server_ip = settings.server_ip
+        # Point to the site's bench host, the default server IP otherwise
+        if not server_ip:
+            settings = frappe.get_single("Zerp Settings")
+            server_ip = settings.server_ip
         
         if not server_ip:
             raise ValueError("Server IP not configured in Zerp Settings")
@@ -238,88 +398,42 @@ def setup_cloudflare_dns(subdomain, cf_settings):
         log_messages.append(f"Base Domain: {cf_settings.get('base_domain')}")
         log_messages.append(f"Server IP: {server_ip}")
         
-        # Prepare Cloudflare API request
-        headers = {
-            "Authorization": f"Bearer {cf_settings['api_token']}",
-            "Content-Type": "application/json"
-        }
-        
-        # Prepare DNS record data
-        data = {
-            "type": "A",
-            "name": subdomain,
-            "content": server_ip,
-            "ttl": 1,
-            "proxied": True
-        }
-        
         # Construct full domain for logging
         full_domain = f"{subdomain}.{cf_settings.get('base_domain')}"
         log_messages.append(f"Full Domain: {full_domain}")
         
-        # Cloudflare API endpoint
-        url = f"https://api.cloudflare.com/client/v4/zones/{cf_settings['zone_id']}/dns_records"
-        log_messages.append(f"Cloudflare API Endpoint: {url}")
-        
         # Perform API request with detailed logging
+        client = CloudflareClient(cf_settings['api_token'], cf_settings['zone_id'])
+        data = get_site_record(subdomain, server_ip)
         try:
-            import requests
-            
-            # Log request details
             log_messages.append("Sending Cloudflare DNS Record Creation Request")
-            log_messages.append(f"Request Headers: {headers}")
             log_messages.append(f"Request Data: {data}")
             
-            # Make the API request
-            response = requests.post(url, headers=headers, json=data)
-            
-            # Log response details
-            log_messages.append(f"Response Status Code: {response.status_code}")
-            log_messages.append(f"Response Headers: {response.headers}")
-            
-            # Parse response
-            response_data = response.json()
-            log_messages.append(f"Response JSON: {response_data}")
+            record = client.create_dns_record(data)
+            log_messages.append(f"Created DNS record: {record.get('id') if record else None}")
+        
+        except CloudflareError as api_error:
+            # Log detailed error
+            log_messages.append(f"Cloudflare API Error: {str(api_error)}")
             
-            # Check for success
-            if not response_data.get('success', False):
-                # Log detailed error
-                log_messages.append("Cloudflare API Error:")
-                log_messages.append(f"Errors: {response_data.get('errors', 'No specific errors')}")
-                log_messages.append(f"Messages: {response_data.get('messages', 'No messages')}")
-                
-                # Check for specific error conditions
-                errors = response_data.get('errors', [])
-                for error in errors:
-                    # Check for duplicate record error
-                    if error.get('code') == 81057:
-                        log_messages.append("DNS record already exists. Skipping creation.")
-                        return {
-                            "success": True,
-                            "message": "DNS record already exists",
-                            "log_messages": log_messages
-                        }
-                
-                # Raise exception for other errors
-                raise Exception(f"Cloudflare DNS setup failed: {errors}")
+            # Check for duplicate record error
+            if api_error.has_code(DUPLICATE_RECORD_CODE):
+                log_messages.append("DNS record already exists. Skipping creation.")
+                return {
+                    "success": True,
+                    "message": "DNS record already exists",
+                    "log_messages": log_messages
+                }
             
-            # Successful creation
-            log_messages.append("Cloudflare DNS record created successfully")
-            return {
-                "success": True,
-                "message": "DNS record created",
-                "log_messages": log_messages
-            }
-        
-        except requests.RequestException as req_error:
-            # Network-level errors
-            log_messages.append(f"Network Error: {str(req_error)}")
             raise
         
-        except Exception as api_error:
-            # Other unexpected errors
-            log_messages.append(f"Unexpected Error: {str(api_error)}")
-            raise
+        # Successful creation
+        log_messages.append("Cloudflare DNS record created successfully")
+        return {
+            "success": True,
+            "message": "DNS record created",
+            "log_messages": log_messages
+        }
     
     except Exception as e:
         # Final catch-all error handling
@@ -335,7 +449,18 @@ def setup_cloudflare_dns(subdomain, cf_settings):
         # Re-raise the exception
         raise Exception(error_message)
 
-def send_success_email(subscription_doc, site_name):
+def site_has_domain(bench_path, site_name, domain):
+    """Check whether the domain is already configured for the site"""
+    config_path = os.path.join(bench_path, "sites", site_name, "site_config.json")
+    try:
+        with open(config_path) as f:
+            domains = json.load(f).get("domains", [])
+    except (OSError, ValueError):
+        return False
+    
+    return any((d.get("domain") if isinstance(d, dict) else d) == domain for d in domains)
+
+def send_success_email(subscription_doc, site_name, admin_password="admin"):
     """Send success email to user"""
     try:
         frappe.sendmail(
@@ -345,7 +470,7 @@ def send_success_email(subscription_doc, site_name):
             args={
                 "site_url": f"https://{site_name}",
                 "username": "Administrator",
-                "password": "admin",
+                "password": admin_password,
                 "user": subscription_doc.user
             }
         )
@@ -0,0 +1,215 @@
+import os
+
+import frappe
+from frappe.utils import get_bench_path, now_datetime
+
+from zerp.zerp.server_scripts.provisioning_log import RunLog
+from zerp.zerp.server_scripts.time_windows import is_within_hours
+
+POOL_SITE_PREFIX = "pool-"
+
+
+def get_plan_app_list(plan):
+    """Return the ordered app names of a subscription plan"""
+    plan_doc = frappe.get_doc("Subscription Plan", plan)
+    return [app.app_name for app in plan_doc.plan_apps]
+
+
+def is_pool_enabled(settings=None):
+    settings = settings or frappe.get_single("Zerp Settings")
+    return bool(getattr(settings, 'enable_site_pool', 0))
+
+
+def claim_pool_site(plan, subscription_name):
+    """Reserve a ready pooled site of the plan for the subscription.
+
+    Returns the claimed Site Pool Entry name, or None when the pool is empty.
+    """
+    apps = ",".join(get_plan_app_list(plan))
+
+    # Lock one ready entry; concurrent claimers skip it instead of waiting
+    entry = frappe.db.sql(
+        """
+        select name from `tabSite Pool Entry`
+        where plan = %s and apps = %s and status = 'Ready'
+        order by creation asc
+        limit 1
+        for update skip locked
+        """,
+        (plan, apps)
+    )
+    if not entry:
+        return None
+
+    entry_name = entry[0][0]
+    frappe.db.set_value("Site Pool Entry", entry_name, {
+        "status": "Claimed",
+        "subscription": subscription_name,
+        "claimed_on": now_datetime()
+    })
+    return entry_name
+
+
+def get_claimed_pool_entry(subscription_name):
+    """Return the pool entry claimed for the subscription that still needs activation"""
+    return frappe.db.get_value(
+        "Site Pool Entry",
+        {"subscription": subscription_name, "status": "Claimed"},
+        ["name", "site_name"],
+        as_dict=True
+    )
+
+
+def get_pool_activation_steps(pool_site_name, site_name, admin_password, bench_path=None):
+    """Return the steps that turn a pooled site into the subscriber's site"""
+    sites_path = os.path.join(bench_path or get_bench_path(), "sites")
+    return [
+        {
+            'key': 'rename_pooled_site',
+            'name': 'Rename Pooled Site',
+            'command': ["mv", f"sites/{pool_site_name}", f"sites/{site_name}"],
+            'is_done': lambda: (
+                os.path.exists(os.path.join(sites_path, site_name))
+                and not os.path.exists(os.path.join(sites_path, pool_site_name))
+            )
+        },
+        {
+            'key': 'reset_admin_password',
+            'name': 'Reset Administrator Password',
+            'command': ["bench", "--site", site_name, "set-admin-password", admin_password]
+        }
+    ]
+
+
+def mark_pool_entry_activated(entry_name):
+    frappe.db.set_value("Site Pool Entry", entry_name, "status", "Activated")
+
+
+def refill_site_pools(force=False):
+    """Top up the warm pool of every plan to its target size.
+
+    Runs hourly from the scheduler but only does work inside the configured
+    idle hours, unless forced.
+    """
+    settings = frappe.get_single("Zerp Settings")
+    if not is_pool_enabled(settings):
+        return
+
+    if not force and not is_within_refill_window(settings):
+        return
+
+    plans = frappe.get_all(
+        "Subscription Plan",
+        filters={"warm_pool_size": [">", 0]},
+        fields=["name", "warm_pool_size"]
+    )
+
+    for plan in plans:
+        apps = ",".join(get_plan_app_list(plan.name))
+
+        # Pooled sites built for an older app list can never be claimed
+        stale_entries = frappe.get_all(
+            "Site Pool Entry",
+            filters={"plan": plan.name, "status": "Ready", "apps": ["!=", apps]},
+            pluck="name"
+        )
+        for entry_name in stale_entries:
+            frappe.db.set_value("Site Pool Entry", entry_name, "status", "Retired")
+            frappe.enqueue(
+                "zerp.zerp.server_scripts.site_pool.drop_pool_site",
+                queue="long",
+                timeout=900,
+                entry_name=entry_name
+            )
+
+        available = frappe.db.count("Site Pool Entry", {
+            "plan": plan.name,
+            "apps": apps,
+            "status": ["in", ["Provisioning", "Ready"]]
+        })
+
+        for _ in range(plan.warm_pool_size - available):
+            entry = frappe.get_doc({
+                "doctype": "Site Pool Entry",
+                "plan": plan.name,
+                "apps": apps,
+                "site_name": f"{POOL_SITE_PREFIX}{frappe.generate_hash(length=10)}.{settings.base_domain}",
+                "status": "Provisioning"
+            }).insert(ignore_permissions=True)
+
+            frappe.enqueue(
+                "zerp.zerp.server_scripts.site_pool.provision_pool_site",
+                queue="long",
+                timeout=1500,
+                entry_name=entry.name
+            )
+
+    frappe.db.commit()
+
+
+def is_within_refill_window(settings):
+    return is_within_hours(settings.pool_refill_start_hour, settings.pool_refill_end_hour)
+
+
+def provision_pool_site(entry_name):
+    """Create a pooled site with all plan apps installed, ready to be claimed"""
+    from zerp.zerp.server_scripts.site_creation import execute_steps, get_site_creation_steps
+
+    entry = frappe.get_doc("Site Pool Entry", entry_name)
+    settings = frappe.get_single("Zerp Settings")
+    log_messages = RunLog(reference=entry)
+
+    try:
+        steps = get_site_creation_steps(
+            entry.site_name,
+            entry.apps.split(",") if entry.apps else [],
+            settings,
+            frappe.generate_hash(length=16),
+            plan=entry.plan
+        )
+        execute_steps(steps, get_bench_path(), log_messages)
+
+        entry.db_set("status", "Ready")
+        frappe.db.commit()
+        log_messages.flush()
+
+    except Exception as e:
+        entry.db_set("status", "Failed")
+        entry.db_set("error", f"{str(e)}\n{frappe.get_traceback()}")
+        frappe.db.commit()
+        log_messages.flush()
+        frappe.log_error(
+            message=f"Pooled site provisioning failed for {entry.site_name}: {str(e)}",
+            title="Site Pool Error"
+        )
+
+
+def drop_pool_site(entry_name):
+    """Drop a retired pooled site"""
+    from zerp.zerp.server_scripts.edge_config import request_site_removal
+    from zerp.zerp.server_scripts.site_creation import execute_steps
+
+    entry = frappe.get_doc("Site Pool Entry", entry_name)
+    settings = frappe.get_single("Zerp Settings")
+
+    try:
+        execute_steps([
+            {
+                'name': 'Drop Pooled Site',
+                'command': [
+                    "bench", "drop-site", entry.site_name,
+                    "--force", "--no-backup",
+                    "--mariadb-root-password", settings.mysql_root_password
+                ]
+            }
+        ], get_bench_path(), RunLog())
+        request_site_removal(entry.site_name)
+
+        entry.delete(ignore_permissions=True)
+        frappe.db.commit()
+
+    except Exception as e:
+        frappe.log_error(
+            message=f"Failed to drop pooled site {entry.site_name}: {str(e)}",
+            title="Site Pool Error"
+        )
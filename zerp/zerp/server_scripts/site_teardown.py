@@ -0,0 +1,265 @@
+import json
+import os
+
+import frappe
+from frappe.utils import add_days, cint, now_datetime, nowdate
+
+from zerp.zerp.server_scripts.bench_hosts import get_host
+from zerp.zerp.server_scripts.cloudflare import get_client
+from zerp.zerp.server_scripts.command_runner import new_run_id
+from zerp.zerp.server_scripts.edge_config import request_site_removal, wait_for_edge_config
+from zerp.zerp.server_scripts.provisioning_log import RunLog
+from zerp.zerp.server_scripts.run_queue import (
+    dispatch_after_run,
+    dispatch_runs,
+    get_running_counts,
+    requeue_stalled_runs,
+    start_run,
+    take_slot,
+)
+from zerp.zerp.server_scripts.site_archive import get_fast_purge_steps, is_fast_purge_enabled
+
+DEFAULT_MAX_CONCURRENT = 4
+DISPATCH_LOCK = "zerp_teardown_dispatch"
+
+UNFINISHED_STATUSES = ("Queued", "Running", "Failed")
+
+
+def get_site_name(subscription_doc, settings=None):
+    if subscription_doc.site_url:
+        return subscription_doc.site_url.replace("https://", "").replace("http://", "")
+
+    settings = settings or frappe.get_single("Zerp Settings")
+    return f"{subscription_doc.sub_domain}.{settings.base_domain}"
+
+
+def submit_teardown(subscription_name, reason, dispatch=True):
+    """Queue the teardown of a subscription's site; a failed teardown is resumed"""
+    teardown_name = frappe.db.get_value(
+        "Site Teardown",
+        {"subscription": subscription_name, "status": ["in", UNFINISHED_STATUSES]},
+        "name",
+        order_by="creation desc"
+    )
+
+    if teardown_name:
+        teardown = frappe.get_doc("Site Teardown", teardown_name)
+        if teardown.status == "Failed":
+            teardown.db_set({"status": "Queued", "queued_at": now_datetime(), "error": None})
+    else:
+        subscription_doc = frappe.get_doc("Subscription", subscription_name)
+        teardown = frappe.get_doc({
+            "doctype": "Site Teardown",
+            "subscription": subscription_name,
+            "site_name": get_site_name(subscription_doc),
+            "bench_host": subscription_doc.bench_host,
+            "reason": reason,
+            "status": "Queued",
+            "queued_at": now_datetime(),
+            "run_id": new_run_id(f"drop-{subscription_name}")
+        }).insert(ignore_permissions=True)
+
+    frappe.db.commit()
+    teardown.publish_progress()
+
+    if dispatch:
+        dispatch_teardowns()
+
+    return teardown.name
+
+
+def dispatch_teardowns():
+    """Start queued teardowns while fewer than the configured number are running"""
+    dispatch_runs(DISPATCH_LOCK, _dispatch)
+
+
+def _dispatch():
+    max_concurrent = (
+        cint(frappe.db.get_single_value("Zerp Settings", "max_concurrent_teardowns"))
+        or DEFAULT_MAX_CONCURRENT
+    )
+    # The cap counts teardowns on all hosts together
+    running = {None: sum(get_running_counts("Site Teardown").values())}
+
+    queued = frappe.get_all(
+        "Site Teardown",
+        filters={"status": "Queued"},
+        order_by="queued_at asc",
+        limit=max_concurrent,
+        pluck="name"
+    )
+
+    for teardown_name in queued:
+        if not take_slot(running, None, max_concurrent):
+            break
+
+        start_run(
+            "Site Teardown",
+            teardown_name,
+            "zerp.zerp.server_scripts.site_teardown.run_teardown",
+            teardown_name=teardown_name
+        )
+
+
+def requeue_stalled_teardowns():
+    """Requeue teardowns whose worker died without recording an outcome"""
+    requeue_stalled_runs("Site Teardown", dispatch_teardowns)
+
+
+def get_teardown_steps(teardown, settings, host):
+    site_name = teardown.site_name
+    steps = [
+        {
+            'key': 'remove_dns',
+            'name': 'Remove DNS Records',
+            'function': lambda: remove_site_dns(site_name, settings)
+        }
+    ]
+
+    if is_fast_purge_enabled(settings):
+        # Archive work is deferred to the archive window
+        steps.extend(get_fast_purge_steps(teardown, settings, host))
+    else:
+        steps.append({
+            'key': 'drop_site',
+            'name': 'Drop Site',
+            'command': [
+                "bench", "drop-site", site_name,
+                "--force",
+                "--mariadb-root-password", settings.mysql_root_password
+            ],
+            'is_done': lambda: not os.path.exists(os.path.join(host.bench_path, "sites", site_name))
+        })
+
+    steps.append(
+        {
+            'key': 'edge_config',
+            'name': 'Nginx Configuration',
+            'function': lambda: wait_for_edge_config(
+                request_site_removal(site_name, host.name), host.name
+            )
+        }
+    )
+    return steps
+
+
+def remove_site_dns(site_name, settings):
+    cloudflare = get_client(settings)
+    if cloudflare:
+        cloudflare.delete_dns_records(site_name)
+
+
+def run_teardown(teardown_name):
+    """Remove DNS, drop the site and update nginx, checkpointing every step"""
+    teardown = frappe.get_doc("Site Teardown", teardown_name)
+    log_messages = RunLog(reference=teardown)
+
+    try:
+        settings = frappe.get_single("Zerp Settings")
+        if not settings.mysql_root_password:
+            raise Exception("Mysql Root Password not configured in Zerp Settings")
+
+        teardown.db_set("status", "Running")
+        frappe.db.commit()
+        teardown.publish_progress()
+
+        host = get_host(teardown.bench_host)
+        teardown.run_steps(get_teardown_steps(teardown, settings, host), host.bench_path, log_messages)
+
+        subscription_doc = frappe.get_doc("Subscription", teardown.subscription)
+        subscription_doc.status = "Cancelled"
+        subscription_doc.save(ignore_permissions=True)
+        subscription_doc.add_comment(
+            "Comment",
+            f"Site {teardown.site_name} and its DNS records were deleted ({teardown.reason})"
+        )
+
+        teardown.db_set({"status": "Completed", "completed_at": now_datetime()})
+        frappe.db.commit()
+        teardown.publish_progress()
+
+    except Exception as e:
+        frappe.db.rollback()
+        teardown.db_set({"status": "Failed", "error": str(e)})
+        frappe.db.commit()
+        teardown.publish_progress()
+        log_messages.error(f"Site teardown failed: {str(e)}")
+        log_messages.flush()
+
+        frappe.log_error(
+            message=f"Site teardown {teardown_name} failed: {str(e)}\n{frappe.get_traceback()}\n"
+            + "\n".join(log_messages),
+            title="Site Teardown Error"
+        )
+        raise
+
+    finally:
+        dispatch_after_run(dispatch_teardowns, "Teardown Dispatch Error")
+
+
+def get_teardown_status(subscription_name):
+    """Return the latest teardown of a subscription with its steps, or None"""
+    teardown_name = frappe.db.get_value(
+        "Site Teardown", {"subscription": subscription_name}, "name", order_by="creation desc"
+    )
+    if not teardown_name:
+        return None
+
+    teardown = frappe.get_doc("Site Teardown", teardown_name)
+    return {
+        "name": teardown.name,
+        "status": teardown.status,
+        "error": teardown.error,
+        "steps": [{"step": row.step_name, "status": row.status} for row in teardown.steps]
+    }
+
+
+def queue_expired_purge():
+    """Queue the teardown of subscriptions expired longer than the configured number of days"""
+    days = cint(frappe.db.get_single_value("Zerp Settings", "purge_expired_after_days"))
+    if days > 0:
+        submit_expired_teardowns(days)
+
+
+def submit_expired_teardowns(days):
+    subscriptions = frappe.get_all(
+        "Subscription",
+        filters={
+            "status": "Expired",
+            "is_site_created": 1,
+            "end_date": ["<", add_days(nowdate(), -days)]
+        },
+        pluck="name"
+    )
+
+    for subscription_name in subscriptions:
+        submit_teardown(subscription_name, "Expiry", dispatch=False)
+
+    dispatch_teardowns()
+    return subscriptions
+
+
+@frappe.whitelist()
+def purge_expired_subscriptions(older_than_days=0, subscriptions=None):
+    """Queue the teardown of many expired subscriptions; they run under the teardown concurrency cap"""
+    frappe.only_for("System Manager")
+
+    if subscriptions:
+        if isinstance(subscriptions, str):
+            subscriptions = json.loads(subscriptions)
+
+        expired = frappe.get_all(
+            "Subscription",
+            filters={"name": ["in", subscriptions], "status": "Expired", "is_site_created": 1},
+            pluck="name"
+        )
+        for subscription_name in expired:
+            submit_teardown(subscription_name, "Expiry", dispatch=False)
+        dispatch_teardowns()
+    else:
+        expired = submit_expired_teardowns(cint(older_than_days))
+
+    return {
+        "success": True,
+        "message": f"Teardown of {len(expired)} expired subscriptions has been queued"
+    }
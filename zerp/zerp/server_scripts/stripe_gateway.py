@@ -0,0 +1,67 @@
+import frappe
+import requests
+import stripe
+from requests.adapters import HTTPAdapter
+
+# Stripe keys of Zerp Settings, cleared when the settings are saved
+SETTINGS_KEY = "zerp_stripe_settings"
+
+# Seconds a single Stripe request may take
+TIMEOUT = 30
+
+# Network failures are retried by the Stripe library with an idempotency key
+MAX_NETWORK_RETRIES = 2
+
+# One client per secret key, so every site of the bench gets its own account
+_clients = {}
+_session = None
+
+
+def get_stripe_settings():
+    """Return the Stripe keys as secret_key, publishable_key and webhook_secret"""
+    return frappe.cache().get_value(SETTINGS_KEY, generator=load_stripe_settings)
+
+
+def load_stripe_settings():
+    values = frappe.db.get_value(
+        "Zerp Settings",
+        None,
+        ["stripe_secret_key", "stripe_publishable_key", "stripe_webhook_secret"],
+        as_dict=True
+    ) or {}
+    return frappe._dict(
+        secret_key=values.get("stripe_secret_key"),
+        publishable_key=values.get("stripe_publishable_key"),
+        webhook_secret=values.get("stripe_webhook_secret")
+    )
+
+
+def clear_stripe_settings(doc=None, method=None):
+    frappe.cache().delete_value(SETTINGS_KEY)
+
+
+def get_session():
+    """Return the keep-alive session shared by all Stripe calls of this process"""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        # Retries are left to the Stripe library, which adds idempotency keys
+        _session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=16, max_retries=0))
+    return _session
+
+
+def get_client():
+    """Return the process wide Stripe client for the secret key of Zerp Settings"""
+    secret_key = get_stripe_settings().secret_key
+    if not secret_key:
+        frappe.throw("Stripe secret key not configured in Zerp Settings")
+
+    client = _clients.get(secret_key)
+    if client is None:
+        client = stripe.StripeClient(
+            secret_key,
+            http_client=stripe.RequestsClient(session=get_session(), timeout=TIMEOUT),
+            max_network_retries=MAX_NETWORK_RETRIES
+        )
+        _clients[secret_key] = client
+    return client
@@ -0,0 +1,101 @@
+import frappe
+
+# Redis hashes mapping Stripe ids to Subscription names, kept current by the
+# Subscription document hooks so webhooks resolve a subscription without a query
+SUBSCRIPTION_MAP = "zerp_stripe_subscription_map"
+CUSTOMER_MAP = "zerp_stripe_customer_map"
+
+# Stripe customer of each user, so checkout reuses it without a query
+USER_CUSTOMER_MAP = "zerp_stripe_user_customer_map"
+
+
+def get_subscription_name(stripe_subscription_id):
+    """Return the Subscription of a Stripe subscription id, or None"""
+    if not stripe_subscription_id:
+        return None
+
+    cache = frappe.cache()
+    name = cache.hget(SUBSCRIPTION_MAP, stripe_subscription_id)
+    if name:
+        return name
+
+    name = frappe.db.get_value("Subscription", {"stripe_subscription_id": stripe_subscription_id}, "name")
+    # Unknown ids are not cached, the subscription may be saved right after
+    if name:
+        cache.hset(SUBSCRIPTION_MAP, stripe_subscription_id, name)
+    return name
+
+
+def get_customer_subscriptions(stripe_customer_id):
+    """Return the Subscriptions of a Stripe customer id, oldest first"""
+    if not stripe_customer_id:
+        return []
+
+    cache = frappe.cache()
+    names = cache.hget(CUSTOMER_MAP, stripe_customer_id)
+    if names:
+        return names
+
+    names = frappe.get_all(
+        "Subscription",
+        filters={"stripe_customer_id": stripe_customer_id},
+        order_by="creation asc",
+        pluck="name"
+    )
+    if names:
+        cache.hset(CUSTOMER_MAP, stripe_customer_id, names)
+    return names
+
+
+def get_user_customer(user):
+    """Return the Stripe customer id of a user, or None if they never checked out"""
+    cache = frappe.cache()
+    customer_id = cache.hget(USER_CUSTOMER_MAP, user)
+    if customer_id:
+        return customer_id
+
+    customer_id = frappe.db.get_value(
+        "Subscription",
+        {"user": user, "stripe_customer_id": ["is", "set"]},
+        "stripe_customer_id",
+        order_by="creation desc"
+    )
+    if customer_id:
+        cache.hset(USER_CUSTOMER_MAP, user, customer_id)
+    return customer_id
+
+
+def set_user_customer(user, customer_id):
+    frappe.cache().hset(USER_CUSTOMER_MAP, user, customer_id)
+
+
+def update_stripe_ids(doc):
+    """Point the cached ids of a saved Subscription at it, dropping ids it no longer has"""
+    cache = frappe.cache()
+    before = doc.get_doc_before_save()
+
+    if before and before.stripe_subscription_id != doc.stripe_subscription_id and before.stripe_subscription_id:
+        cache.hdel(SUBSCRIPTION_MAP, before.stripe_subscription_id)
+    if doc.stripe_subscription_id:
+        cache.hset(SUBSCRIPTION_MAP, doc.stripe_subscription_id, doc.name)
+
+    # A customer can hold several subscriptions, its entry is rebuilt on the next lookup
+    if before and before.stripe_customer_id != doc.stripe_customer_id and before.stripe_customer_id:
+        cache.hdel(CUSTOMER_MAP, before.stripe_customer_id)
+    if doc.stripe_customer_id and (not before or before.stripe_customer_id != doc.stripe_customer_id):
+        cache.hdel(CUSTOMER_MAP, doc.stripe_customer_id)
+        set_user_customer(doc.user, doc.stripe_customer_id)
+
+
+def remove_stripe_ids(doc):
+    """Forget the ids of a deleted Subscription"""
+    cache = frappe.cache()
+    if doc.stripe_subscription_id:
+        cache.hdel(SUBSCRIPTION_MAP, doc.stripe_subscription_id)
+    if doc.stripe_customer_id:
+        cache.hdel(CUSTOMER_MAP, doc.stripe_customer_id)
+
+
+def clear_stripe_id_cache():
+    """Drop all maps, e.g. after Stripe ids were changed directly in the database"""
+    frappe.cache().delete_value([SUBSCRIPTION_MAP, CUSTOMER_MAP, USER_CUSTOMER_MAP])
@@ -0,0 +1,198 @@
+from datetime import datetime
+
+import frappe
+from frappe.utils import cint, get_datetime, now_datetime
+
+from zerp.zerp.server_scripts.stripe_gateway import get_client
+from zerp.zerp.server_scripts.stripe_lookup import get_customer_subscriptions, get_subscription_name
+
+# Largest page the Stripe list endpoints return
+PAGE_SIZE = 100
+
+
+def get_id(value):
+    """Return the id of a Stripe reference, which is either an id or an expanded object"""
+    if value and not isinstance(value, str):
+        return value.get("id")
+    return value
+
+
+def get_time(timestamp):
+    return datetime.fromtimestamp(timestamp) if timestamp else None
+
+
+def upsert_record(doctype, name, values, event_time=None):
+    """Insert or update a mirror record; changes older than the stored state are ignored.
+
+    Backfilled objects are current as of now, webhook changes as of their event.
+    Returns whether the record was written.
+    """
+    event_time = event_time or now_datetime()
+    values.update(last_event_at=event_time, synced_at=now_datetime())
+
+    existing = frappe.db.get_value(doctype, name, ["name", "last_event_at"], as_dict=True)
+    if not existing:
+        doc = frappe.get_doc(dict(values, doctype=doctype))
+        doc.name = name
+        # Objects arrive in any order, a subscription may come before its customer
+        doc.flags.ignore_links = True
+        try:
+            doc.insert(ignore_permissions=True)
+            return True
+        except frappe.DuplicateEntryError:
+            # Inserted by a concurrent event in the meantime
+            existing = frappe.db.get_value(doctype, name, ["name", "last_event_at"], as_dict=True)
+
+    if existing.last_event_at and get_datetime(existing.last_event_at) > get_datetime(event_time):
+        return False
+
+    frappe.db.set_value(doctype, name, values)
+    return True
+
+
+def upsert_customer(customer, event_time=None, deleted=False):
+    values = {
+        "customer_id": customer.id,
+        "email": customer.get("email"),
+        "customer_name": customer.get("name"),
+        "created_at": get_time(customer.get("created")),
+        "default_payment_method": get_id((customer.get("invoice_settings") or {}).get("default_payment_method")),
+        "delinquent": cint(customer.get("delinquent")),
+        "deleted": cint(deleted or customer.get("deleted")),
+        "livemode": cint(customer.get("livemode"))
+    }
+
+    if not frappe.db.get_value("Stripe Customer", customer.id, "user"):
+        values["user"] = get_customer_user(customer.id, values["email"])
+
+    return upsert_record("Stripe Customer", customer.id, values, event_time)
+
+
+def get_customer_user(customer_id, email=None):
+    """Return the user a Stripe customer belongs to, by their subscriptions or else by email"""
+    subscriptions = get_customer_subscriptions(customer_id)
+    if subscriptions:
+        return frappe.db.get_value("Subscription", subscriptions[0], "user")
+    if email:
+        return frappe.db.get_value("User", {"email": email}, "name")
+    return None
+
+
+def get_first_item(subscription):
+    items = (subscription.get("items") or {}).get("data") or []
+    return items[0] if items else {}
+
+
+def get_current_period(subscription):
+    """Return the start and end timestamps of the current billing period"""
+    item = get_first_item(subscription)
+    # Newer API versions keep the billing period on the items
+    return (
+        subscription.get("current_period_start") or item.get("current_period_start"),
+        subscription.get("current_period_end") or item.get("current_period_end")
+    )
+
+
+def upsert_subscription(subscription, event_time=None):
+    item = get_first_item(subscription)
+    period_start, period_end = get_current_period(subscription)
+
+    return upsert_record("Stripe Subscription", subscription.id, {
+        "subscription_id": subscription.id,
+        "customer": get_id(subscription.get("customer")),
+        "subscription": get_subscription_name(subscription.id),
+        "status": subscription.get("status"),
+        "price_id": get_id(item.get("price")),
+        "created_at": get_time(subscription.get("created")),
+        "current_period_start": get_time(period_start),
+        "current_period_end": get_time(period_end),
+        "trial_end": get_time(subscription.get("trial_end")),
+        "cancel_at_period_end": cint(subscription.get("cancel_at_period_end")),
+        "canceled_at": get_time(subscription.get("canceled_at")),
+        "livemode": cint(subscription.get("livemode"))
+    }, event_time)
+
+
+def upsert_invoice(invoice, event_time=None):
+    subscription_id = get_invoice_subscription_id(invoice)
+    paid_at = (invoice.get("status_transitions") or {}).get("paid_at")
+
+    return upsert_record("Stripe Invoice", invoice.id, {
+        "invoice_id": invoice.id,
+        "number": invoice.get("number"),
+        "customer": get_id(invoice.get("customer")),
+        "stripe_subscription": subscription_id,
+        "subscription": get_subscription_name(subscription_id),
+        "status": invoice.get("status"),
+        "currency": (invoice.get("currency") or "").upper(),
+        # Stripe amounts are in the smallest currency unit
+        "amount_due": (invoice.get("amount_due") or 0) / 100,
+        "amount_paid": (invoice.get("amount_paid") or 0) / 100,
+        "created_at": get_time(invoice.get("created")),
+        "due_date": get_time(invoice.get("due_date")),
+        "paid_at": get_time(paid_at),
+        "hosted_invoice_url": invoice.get("hosted_invoice_url"),
+        "livemode": cint(invoice.get("livemode"))
+    }, event_time)
+
+
+def get_invoice_subscription_id(invoice):
+    subscription_id = get_id(invoice.get("subscription"))
+    if not subscription_id:
+        # Newer API versions moved it under the invoice parent
+        details = (invoice.get("parent") or {}).get("subscription_details") or {}
+        subscription_id = get_id(details.get("subscription"))
+    return subscription_id
+
+
+@frappe.whitelist()
+def backfill_stripe_mirror():
+    """Queue a full copy of the Stripe customers, subscriptions and invoices"""
+    frappe.only_for("System Manager")
+    frappe.enqueue(
+        "zerp.zerp.server_scripts.stripe_mirror.run_backfill",
+        queue="long",
+        timeout=14400
+    )
+    return {"success": True, "message": "Stripe backfill has been queued"}
+
+
+def run_backfill():
+    """Page through all Stripe customers, subscriptions and invoices and mirror them.
+
+    Webhooks keep running meanwhile; a record they changed after the page
+    was fetched is not overwritten.
+    """
+    client = get_client()
+    counts = {}
+    for doctype, service, upsert, params in (
+        ("Stripe Customer", client.customers, upsert_customer, {}),
+        ("Stripe Subscription", client.subscriptions, upsert_subscription, {"status": "all"}),
+        ("Stripe Invoice", client.invoices, upsert_invoice, {})
+    ):
+        try:
+            counts[doctype] = backfill(service, upsert, params)
+        except Exception:
+            frappe.db.rollback()
+            frappe.log_error(frappe.get_traceback(), f"Stripe Backfill Error: {doctype}")
+
+    return counts
+
+
+def backfill(service, upsert, params):
+    count = 0
+    starting_after = None
+    while True:
+        fetched_at = now_datetime()
+        page = service.list(params=dict(params, limit=PAGE_SIZE, **(
+            {"starting_after": starting_after} if starting_after else {}
+        )))
+
+        for obj in page.data:
+            upsert(obj, fetched_at)
+        frappe.db.commit()
+
+        count += len(page.data)
+        if not page.has_more or not page.data:
+            return count
+        starting_after = page.data[-1].id
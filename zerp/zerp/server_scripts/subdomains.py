@@ -0,0 +1,150 @@
+import re
+
+import frappe
+
+SUBDOMAIN_PATTERN = re.compile(r"^[a-z0-9][a-z0-9-]*[a-z0-9]$")
+MAX_LENGTH = 63
+
+# Names kept for our own services, refused without a query
+RESERVED_SUBDOMAINS = frozenset((
+    "www", "mail", "api", "app", "admin", "administrator", "support", "help",
+    "docs", "blog", "status", "billing", "login", "signup", "account", "dashboard",
+    "static", "assets", "cdn", "files", "ftp", "smtp", "imap", "pop", "ns1", "ns2",
+    "test", "staging", "dev", "demo", "zerp"
+))
+
+# Whether a subdomain is used by a Subscription, cleared when one is inserted or deleted
+TAKEN_KEY = "zerp_subdomain_taken"
+TAKEN_CACHE_SECONDS = 300
+
+# Held by the user in checkout; long enough to enter card details
+RESERVATION_KEY = "zerp_subdomain_reservation"
+RESERVATION_SECONDS = 900
+
+MAX_SUGGESTIONS = 3
+
+
+def normalize(subdomain):
+    return (subdomain or "").strip().lower()
+
+
+def get_pattern_error(subdomain):
+    """Return why a subdomain is not a valid host label at all, or None"""
+    if not subdomain:
+        return "Subdomain is required"
+    if not SUBDOMAIN_PATTERN.match(subdomain):
+        return "Invalid subdomain. Use only lowercase letters, numbers, and hyphens"
+    return None
+
+
+def get_format_error(subdomain):
+    """Return why a subdomain can not be used regardless of who holds it, or None"""
+    error = get_pattern_error(subdomain)
+    if error:
+        return error
+    if len(subdomain) > MAX_LENGTH:
+        return "Invalid subdomain. Use only lowercase letters, numbers, and hyphens"
+    if subdomain in RESERVED_SUBDOMAINS:
+        return f"Subdomain {subdomain} is reserved"
+    return None
+
+
+def get_reservation_key(subdomain):
+    return frappe.cache().make_key(f"{RESERVATION_KEY}:{subdomain}")
+
+
+def get_reservation_owner(subdomain):
+    return frappe.safe_decode(frappe.cache().get(get_reservation_key(subdomain)))
+
+
+def is_taken(subdomain):
+    cache = frappe.cache()
+    taken = cache.hget(TAKEN_KEY, subdomain)
+    if taken is None:
+        taken = bool(frappe.db.exists("Subscription", {"sub_domain": subdomain}))
+        cache.hset(TAKEN_KEY, subdomain, taken)
+        # The whole map expires now and then, so it can not grow without bound
+        if cache.ttl(cache.make_key(TAKEN_KEY)) < 0:
+            cache.expire(cache.make_key(TAKEN_KEY), TAKEN_CACHE_SECONDS)
+    return taken
+
+
+def clear_taken(subdomain):
+    frappe.cache().hdel(TAKEN_KEY, subdomain)
+
+
+def check_subdomain(subdomain, user=None):
+    """Return whether a subdomain can be used by the user, with free alternatives if not"""
+    subdomain = normalize(subdomain)
+    error = get_format_error(subdomain)
+    if not error:
+        owner = get_reservation_owner(subdomain)
+        if is_taken(subdomain) or (owner and owner != user):
+            error = "This subdomain is already taken. Please choose another one."
+
+    if not error:
+        return {"available": True, "subdomain": subdomain}
+
+    return {
+        "available": False,
+        "subdomain": subdomain,
+        "message": error,
+        "suggestions": get_suggestions(subdomain, user)
+    }
+
+
+def reserve_subdomain(subdomain, user):
+    """Hold a subdomain for the user during checkout; returns the result of check_subdomain.
+
+    The reservation is taken atomically in redis, so of two concurrent
+    signups only one gets past this point. Renewing an own reservation
+    extends it.
+    """
+    result = check_subdomain(subdomain, user)
+    if not result["available"]:
+        return result
+
+    cache = frappe.cache()
+    key = get_reservation_key(result["subdomain"])
+    if not cache.set(key, user, nx=True, ex=RESERVATION_SECONDS):
+        if get_reservation_owner(result["subdomain"]) != user:
+            return check_subdomain(subdomain, user)
+        cache.expire(key, RESERVATION_SECONDS)
+
+    return result
+
+
+def release_subdomain(subdomain, user=None):
+    """Drop a reservation, only if it is held by the user when one is given"""
+    subdomain = normalize(subdomain)
+    if user and get_reservation_owner(subdomain) != user:
+        return
+    frappe.cache().delete(get_reservation_key(subdomain))
+
+
+def get_suggestions(subdomain, user=None):
+    """Return free variants of a subdomain, looked up with one prefix query on the unique index"""
+    base = re.sub(r"[^a-z0-9-]", "", subdomain)[:MAX_LENGTH - 4].strip("-")
+    if not base:
+        return []
+
+    taken = set(frappe.get_all(
+        "Subscription",
+        filters={"sub_domain": ["like", f"{base}-%"]},
+        pluck="sub_domain"
+    ))
+
+    suggestions = []
+    for number in range(1, 100):
+        candidate = f"{base}-{number}"
+        if candidate in taken or get_format_error(candidate):
+            continue
+        owner = get_reservation_owner(candidate)
+        if owner and owner != user:
+            continue
+
+        suggestions.append(candidate)
+        if len(suggestions) == MAX_SUGGESTIONS:
+            break
+
+    return suggestions
@@ -0,0 +1,16 @@
+from frappe.utils import now_datetime
+
+
+def is_within_hours(start_hour, end_hour):
+    """Whether the current hour falls in [start_hour, end_hour); equal hours mean always"""
+    start_hour = start_hour or 0
+    end_hour = end_hour or 0
+    if start_hour == end_hour:
+        return True
+
+    hour = now_datetime().hour
+    if start_hour < end_hour:
+        return start_hour <= hour < end_hour
+
+    # Window wraps around midnight, e.g. 22 -> 6
+    return hour >= start_hour or hour < end_hour
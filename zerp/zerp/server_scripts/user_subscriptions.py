@@ -0,0 +1,76 @@
+import frappe
+
+# Subscriptions shown per page, agencies hold hundreds of them
+PAGE_SIZE = 20
+
+# First page per status filter and status counts of each user, dropped whenever
+# one of the user's subscriptions changes
+SUMMARY_CACHE = "zerp_my_subscriptions"
+
+SUBSCRIPTION_FIELDS = (
+    "name", "sub_domain", "plan", "plan_name", "plan_monthly_subscription",
+    "start_date", "end_date", "status", "is_site_created", "site_url", "creation"
+)
+
+
+def get_user_summary(user, status=""):
+    """Return the status counts and first page of a user's subscriptions, cached per user"""
+    cache = frappe.cache()
+    summary = cache.hget(SUMMARY_CACHE, user) or {}
+
+    if "counts" not in summary or status not in summary.get("pages", {}):
+        if "counts" not in summary:
+            summary["counts"] = dict(frappe.db.sql(
+                "select status, count(*) from `tabSubscription` where user = %s group by status",
+                user
+            ))
+        summary.setdefault("pages", {})[status] = get_user_subscriptions(user, status)
+        cache.hset(SUMMARY_CACHE, user, summary)
+
+    return {"counts": summary["counts"], "page": summary["pages"][status]}
+
+
+def clear_user_summary(user):
+    if user:
+        frappe.cache().hdel(SUMMARY_CACHE, user)
+
+
+def get_user_subscriptions(user, status="", cursor=None, limit=PAGE_SIZE):
+    """Return one page of a user's subscriptions, newest first.
+
+    Pages are keyed on (creation, name): the cursor is the last row of the
+    previous page, so every page is an index range scan however deep it is.
+    """
+    conditions = ["user = %(user)s"]
+    values = {"user": user, "limit": limit + 1}
+
+    if status == "":
+        conditions.append("status != 'Cancelled'")
+    elif status != "All":
+        conditions.append("status = %(status)s")
+        values["status"] = status
+
+    if cursor:
+        creation, _, name = cursor.partition("|")
+        conditions.append("(creation < %(creation)s or (creation = %(creation)s and name < %(name)s))")
+        values.update(creation=creation, name=name)
+
+    subscriptions = frappe.db.sql(
+        f"""
+        select {", ".join(SUBSCRIPTION_FIELDS)}
+        from `tabSubscription`
+        where {" and ".join(conditions)}
+        order by creation desc, name desc
+        limit %(limit)s
+        """,
+        values,
+        as_dict=True
+    )
+
+    next_cursor = None
+    if len(subscriptions) > limit:
+        subscriptions = subscriptions[:limit]
+        last = subscriptions[-1]
+        next_cursor = f"{last.creation}|{last.name}"
+
+    return {"subscriptions": subscriptions, "next_cursor": next_cursor}
@@ -1,65 +1,161 @@
 import frappe
 from frappe import _
 import stripe
-import json
-from frappe.utils import now_datetime, add_days, get_url
+from datetime import datetime
+from frappe.utils import now_datetime, get_datetime, get_url
+from zerp.zerp.server_scripts.bench_hosts import refresh_tenant_count
+from zerp.zerp.server_scripts.stripe_lookup import get_subscription_name
+from zerp.zerp.server_scripts.stripe_mirror import (
+    get_current_period,
+    get_invoice_subscription_id,
+    upsert_customer,
+    upsert_invoice,
+    upsert_subscription,
+)
+from zerp.zerp.server_scripts.user_subscriptions import clear_user_summary
 
-def handle_webhook(request):
-    """Handle Stripe webhook events"""
-    try:
-        event = stripe.Event.construct_from(
-            json.loads(request.data), stripe.api_key
+# Stripe event type -> handler, filled by the @handles decorator
+EVENT_HANDLERS = {}
+
+# Event types of which only the latest per Stripe object needs to be applied
+COALESCED_EVENT_TYPES = set()
+
+def handles(*event_types, coalesce=False):
+    """Register a function as the handler of the given Stripe event types"""
+    def decorator(handler):
+        for event_type in event_types:
+            EVENT_HANDLERS[event_type] = handler
+            if coalesce:
+                COALESCED_EVENT_TYPES.add(event_type)
+        return handler
+    return decorator
+
+def get_event_time(event):
+    """Return the time Stripe created the event"""
+    return datetime.fromtimestamp(event.created)
+
+def get_date(timestamp):
+    """Return the date of a Stripe unix timestamp, or None"""
+    return datetime.fromtimestamp(timestamp).date() if timestamp else None
+
+# Attempts of a partial update that lost the race against another writer
+MAX_UPDATE_ATTEMPTS = 3
+
+# Read along with the guard of every partial update
+SUBSCRIPTION_FIELDS = ["name", "modified", "status", "is_site_created", "subscription_type", "bench_host", "user"]
+
+def is_stale(row, fieldname, event):
+    """Whether a newer Stripe event has already been applied to the subscription"""
+    last_event_at = row.get(fieldname)
+    return bool(last_event_at and get_datetime(last_event_at) > get_event_time(event))
+
+def update_subscription(sub_name, event, event_field, values):
+    """Apply webhook driven field changes to a Subscription with one UPDATE.
+
+    Skips the full document save: the row is written only if its modified
+    timestamp is still the one read, and is read again when another writer
+    got in between. Returns the values before the update, or None if a newer
+    event was already applied. Only fields without document hooks of their
+    own may be changed here, Stripe ids in particular go through save().
+    """
+    for _attempt in range(MAX_UPDATE_ATTEMPTS):
+        row = frappe.db.get_value(
+            "Subscription", sub_name, SUBSCRIPTION_FIELDS + [event_field], as_dict=True
         )
-        
-        # Handle different event types
-        if event.type == 'customer.subscription.created':
-            handle_subscription_created(event.data.object)
-        elif event.type == 'customer.subscription.updated':
-            handle_subscription_updated(event.data.object)
-        elif event.type == 'customer.subscription.deleted':
-            handle_subscription_deleted(event.data.object)
-        elif event.type == 'invoice.paid':
-            handle_invoice_paid(event.data.object)
-        elif event.type == 'invoice.payment_failed':
-            handle_payment_failed(event.data.object)
-            
-        return {"success": True}
-        
-    except Exception as e:
-        frappe.log_error(
-            message=f"Webhook handling failed: {str(e)}\n{frappe.get_traceback()}",
-            title="Stripe Webhook Error"
+        if not row:
+            return None
+
+        # Never let a late delivery overwrite newer state
+        if is_stale(row, event_field, event):
+            return None
+
+        changes = dict(values)
+        changes[event_field] = get_event_time(event)
+        changes["modified"] = now_datetime()
+        changes["modified_by"] = frappe.session.user
+
+        assignments = ", ".join(f"`{fieldname}` = %({fieldname})s" for fieldname in changes)
+        frappe.db.sql(
+            f"""
+            update `tabSubscription` set {assignments}
+            where name = %(__name)s and modified = %(__modified)s
+            """,
+            dict(changes, __name=sub_name, __modified=row.modified)
         )
-        return {"success": False, "message": str(e)}
+        # The row carries our modified timestamp only if the guard matched
+        if get_datetime(frappe.db.get_value("Subscription", sub_name, "modified")) == changes["modified"]:
+            after_subscription_update(row, values)
+            return row
+
+    raise frappe.TimestampMismatchError(f"Subscription {sub_name} kept changing, the event will be retried")
+
+def after_subscription_update(row, values):
+    """Run what the Subscription on_update and on_change hooks would for the changed fields"""
+    frappe.clear_document_cache("Subscription", row.name)
+    clear_user_summary(row.user)
+
+    # A cancelled subscription frees its slot on the bench host
+    if values.get("status") == "Cancelled" and row.status != "Cancelled":
+        refresh_tenant_count(row.bench_host)
+
+def add_subscription_comment(sub_name, content):
+    frappe.get_doc({
+        "doctype": "Comment",
+        "comment_type": "Comment",
+        "reference_doctype": "Subscription",
+        "reference_name": sub_name,
+        "content": content
+    }).insert(ignore_permissions=True)
+
+def handle_event(event):
+    """Run the registered handler of a verified Stripe event; handler errors are raised"""
+    handler = EVENT_HANDLERS.get(event.type)
+    if handler:
+        handler(event.data.object, event)
+
+@handles('customer.created')
+@handles('customer.updated', coalesce=True)
+def handle_customer_changed(customer, event):
+    """Keep the local copy of the customer current"""
+    upsert_customer(customer, get_event_time(event))
 
-def handle_subscription_created(subscription):
+@handles('customer.deleted')
+def handle_customer_deleted(customer, event):
+    upsert_customer(customer, get_event_time(event), deleted=True)
+
+@handles('invoice.created', 'invoice.finalized', 'invoice.voided', 'invoice.marked_uncollectible')
+@handles('invoice.updated', coalesce=True)
+def handle_invoice_changed(invoice, event):
+    """Keep the local copy of the invoice current"""
+    upsert_invoice(invoice, get_event_time(event))
+
+@handles('customer.subscription.created')
+def handle_subscription_created(subscription, event):
     """Handle new subscription creation"""
     try:
-        # Get subscription doc
-        sub_name = frappe.get_value(
-            "Subscription",
-            {"stripe_subscription_id": subscription.id},
-            "name"
-        )
+        upsert_subscription(subscription, get_event_time(event))
+
+        sub_name = get_subscription_name(subscription.id)
         
         if not sub_name:
             return
             
-        sub_doc = frappe.get_doc("Subscription", sub_name)
-        
         # Update subscription details
-        sub_doc.trial_end_date = add_days(now_datetime(), subscription.trial_end) if subscription.trial_end else None
-        sub_doc.next_billing_date = add_days(now_datetime(), subscription.current_period_end)
-        sub_doc.status = "Active"
-        
-        sub_doc.save()
+        row = update_subscription(sub_name, event, 'last_subscription_event_at', {
+            "trial_end_date": get_date(subscription.get("trial_end")),
+            "next_billing_date": get_date(get_current_period(subscription)[1]),
+            "status": "Active"
+        })
         
-        # Trigger site creation if not already created
-        if not sub_doc.is_site_created:
+        # Trigger site creation if not already created; submit_provisioning commits,
+        # so it runs once the event is marked processed and the inbox row released
+        if row and not row.is_site_created:
             frappe.enqueue(
-                "zerp.zerp.site_creation.create_new_site",
-                subscription=sub_doc.name,
-                now=True
+                "zerp.zerp.server_scripts.provisioning_scheduler.submit_provisioning",
+                queue="short",
+                enqueue_after_commit=True,
+                subscription_name=row.name,
+                subscription_type=row.subscription_type
             )
             
     except Exception as e:
@@ -67,135 +163,130 @@ def handle_subscription_created(subscription):
             message=f"Error handling subscription created: {str(e)}",
             title="Subscription Creation Error"
         )
+        raise
 
-def handle_subscription_updated(subscription):
+@handles('customer.subscription.updated', coalesce=True)
+def handle_subscription_updated(subscription, event):
     """Handle subscription updates"""
     try:
-        sub_name = frappe.get_value(
-            "Subscription",
-            {"stripe_subscription_id": subscription.id},
-            "name"
-        )
+        upsert_subscription(subscription, get_event_time(event))
+
+        sub_name = get_subscription_name(subscription.id)
         
         if not sub_name:
             return
             
-        sub_doc = frappe.get_doc("Subscription", sub_name)
-        
         # Update subscription status
         status_map = {
             'trialing': 'Active',
             'active': 'Active',
-            'past_due': 'Past Due',
-            'canceled': 'Cancelled',
-            'unpaid': 'Past Due'
+            'canceled': 'Cancelled'
         }
         
-        sub_doc.status = status_map.get(subscription.status, sub_doc.status)
-        sub_doc.next_billing_date = add_days(now_datetime(), subscription.current_period_end)
+        values = {}
+        period_end = get_current_period(subscription)[1]
+        if period_end:
+            values["next_billing_date"] = get_date(period_end)
+        if subscription.status in status_map:
+            values["status"] = status_map[subscription.status]
+        elif subscription.status in ('past_due', 'unpaid'):
+            # Overdue subscriptions keep their site, the missed payment is shown by payment_status
+            values["payment_status"] = "Failed"
         
-        if subscription.trial_end:
-            sub_doc.trial_end_date = add_days(now_datetime(), subscription.trial_end)
+        if subscription.get("trial_end"):
+            values["trial_end_date"] = get_date(subscription.trial_end)
             
-        sub_doc.save()
+        update_subscription(sub_name, event, 'last_subscription_event_at', values)
         
     except Exception as e:
         frappe.log_error(
             message=f"Error handling subscription update: {str(e)}",
             title="Subscription Update Error"
         )
+        raise
 
-def handle_subscription_deleted(subscription):
+@handles('customer.subscription.deleted')
+def handle_subscription_deleted(subscription, event):
     """Handle subscription cancellation"""
     try:
-        sub_name = frappe.get_value(
-            "Subscription",
-            {"stripe_subscription_id": subscription.id},
-            "name"
-        )
+        upsert_subscription(subscription, get_event_time(event))
+
+        sub_name = get_subscription_name(subscription.id)
         
         if not sub_name:
             return
             
-        sub_doc = frappe.get_doc("Subscription", sub_name)
-        sub_doc.status = "Cancelled"
-        sub_doc.save()
+        update_subscription(sub_name, event, 'last_subscription_event_at', {"status": "Cancelled"})
         
     except Exception as e:
         frappe.log_error(
             message=f"Error handling subscription deletion: {str(e)}",
             title="Subscription Deletion Error"
         )
+        raise
 
-def handle_invoice_paid(invoice):
+@handles('invoice.paid')
+def handle_invoice_paid(invoice, event):
     """Handle successful payment"""
     try:
-        if not invoice.subscription:
-            return
-            
-        sub_name = frappe.get_value(
-            "Subscription",
-            {"stripe_subscription_id": invoice.subscription},
-            "name"
-        )
+        upsert_invoice(invoice, get_event_time(event))
+
+        sub_name = get_subscription_name(get_invoice_subscription_id(invoice))
         
         if not sub_name:
             return
             
-        sub_doc = frappe.get_doc("Subscription", sub_name)
+        row = update_subscription(sub_name, event, 'last_invoice_event_at', {
+            "payment_status": "Paid",
+            "payment_date": now_datetime()
+        })
+        if not row:
+            return
         
         # Add payment record
-        sub_doc.add_comment(
-            "Comment",
+        add_subscription_comment(
+            sub_name,
             f"Payment received: ${invoice.amount_paid/100:.2f} - Invoice ID: {invoice.id}"
         )
         
-        sub_doc.payment_status = "Paid"
-        sub_doc.last_payment_date = now_datetime()
-        sub_doc.save()
-        
     except Exception as e:
         frappe.log_error(
             message=f"Error handling invoice payment: {str(e)}",
             title="Invoice Payment Error"
         )
+        raise
 
-def handle_payment_failed(invoice):
+@handles('invoice.payment_failed')
+def handle_payment_failed(invoice, event):
     """Handle failed payment"""
     try:
-        if not invoice.subscription:
-            return
-            
-        sub_name = frappe.get_value(
-            "Subscription",
-            {"stripe_subscription_id": invoice.subscription},
-            "name"
-        )
+        upsert_invoice(invoice, get_event_time(event))
+
+        sub_name = get_subscription_name(get_invoice_subscription_id(invoice))
         
         if not sub_name:
             return
             
-        sub_doc = frappe.get_doc("Subscription", sub_name)
+        row = update_subscription(sub_name, event, 'last_invoice_event_at', {"payment_status": "Failed"})
+        if not row:
+            return
         
         # Add payment failure record
-        sub_doc.add_comment(
-            "Comment",
+        add_subscription_comment(
+            sub_name,
             f"Payment failed for amount ${invoice.amount_due/100:.2f} - Invoice ID: {invoice.id}"
         )
         
-        sub_doc.payment_status = "Failed"
-        sub_doc.save()
-        
         # Notify user
         frappe.sendmail(
-            recipients=[sub_doc.user],
+            recipients=[row.user],
             subject="Payment Failed for Your Subscription",
             message=f"""
 Dear User,
 
 The payment for your subscription has failed. Please update your payment information to avoid service interruption.
 
-Subscription: {sub_doc.name}
+Subscription: {sub_name}
 Amount Due: ${invoice.amount_due/100:.2f}
 Due Date: {invoice.due_date}
 
@@ -210,4 +301,5 @@ Your Service Team
         frappe.log_error(
             message=f"Error handling payment failure: {str(e)}",
             title="Payment Failure Error"
-        )
\ No newline at end of file
+        )
+        raise
\ No newline at end of file
@@ -0,0 +1,189 @@
+import json
+
+import frappe
+import stripe
+from frappe.utils import add_to_date, cint, now_datetime
+
+from .stripe_webhooks import COALESCED_EVENT_TYPES, get_event_time, handle_event
+
+# Failed events are retried by the drain until they reach this many attempts
+MAX_ATTEMPTS = 5
+
+# Pending events younger than this are left to the job enqueued on receipt
+DRAIN_GRACE_MINUTES = 2
+DRAIN_BATCH_SIZE = 100
+
+
+def store_event(event, payload):
+    """Save a verified Stripe event to the inbox; returns False if it was received before"""
+    doc = frappe.get_doc({
+        "doctype": "Stripe Webhook Event",
+        "event_id": event.id,
+        "event_type": event.type,
+        "object_id": event.data.object.get("id"),
+        "event_created": get_event_time(event),
+        "livemode": cint(event.livemode),
+        "status": "Pending",
+        "received_at": now_datetime(),
+        "payload": frappe.safe_decode(payload)
+    })
+    doc.name = event.id
+
+    try:
+        # Plain insert, the endpoint has to answer Stripe right away
+        doc.db_insert()
+    except frappe.DuplicateEntryError:
+        return False
+
+    frappe.enqueue(
+        "zerp.zerp.webhook_inbox.process_event",
+        queue="short",
+        event_id=event.id,
+        enqueue_after_commit=True
+    )
+    return True
+
+
+def process_event(event_id):
+    """Run the handler of a stored event once.
+
+    The inbox row stays locked while the handler runs, so a duplicate job
+    waits and then finds the event already processed. Handlers must not
+    commit; work that does is enqueued with enqueue_after_commit.
+    """
+    event = frappe.db.sql(
+        """
+        select name, status, attempts, payload, event_type, object_id, event_created
+        from `tabStripe Webhook Event`
+        where name = %s
+        for update
+        """,
+        event_id,
+        as_dict=True
+    )
+    if not event or event[0].status in ("Processed", "Superseded"):
+        frappe.db.rollback()
+        return
+
+    event = event[0]
+
+    # Of a burst of updates to one object only the latest is applied
+    if event.event_type in COALESCED_EVENT_TYPES and has_newer_event(event):
+        frappe.db.set_value("Stripe Webhook Event", event_id, {
+            "status": "Superseded",
+            "processed_at": now_datetime()
+        }, update_modified=False)
+        frappe.db.commit()
+        return
+
+    try:
+        # The payload was verified on receipt and is parsed exactly once here
+        handle_event(stripe.Event.construct_from(json.loads(event.payload), stripe.api_key))
+    except Exception as e:
+        frappe.db.rollback()
+        frappe.db.set_value("Stripe Webhook Event", event_id, {
+            "status": "Failed",
+            "attempts": cint(event.attempts) + 1,
+            "error": f"{str(e)}\n{frappe.get_traceback()}"
+        }, update_modified=False)
+        frappe.db.commit()
+        frappe.log_error(
+            message=f"Stripe event {event_id} failed: {str(e)}\n{frappe.get_traceback()}",
+            title="Stripe Webhook Error"
+        )
+        return
+
+    frappe.db.set_value("Stripe Webhook Event", event_id, {
+        "status": "Processed",
+        "attempts": cint(event.attempts) + 1,
+        "processed_at": now_datetime(),
+        "error": None
+    }, update_modified=False)
+    frappe.db.commit()
+
+
+def has_newer_event(event):
+    """Whether the same object has a later event of the same type that is applied or will be"""
+    return bool(frappe.db.sql(
+        """
+        select name from `tabStripe Webhook Event`
+        where event_type = %s and object_id = %s and event_created > %s
+            and (status in ('Pending', 'Processed') or (status = 'Failed' and attempts < %s))
+        limit 1
+        """,
+        (event.event_type, event.object_id, event.event_created, MAX_ATTEMPTS)
+    ))
+
+
+def drain_webhook_inbox():
+    """Process events whose job was lost and retry failed ones, oldest Stripe event first"""
+    events = frappe.db.sql(
+        """
+        select name from `tabStripe Webhook Event`
+        where (status = 'Pending' and received_at < %s)
+            or (status = 'Failed' and attempts < %s)
+        order by event_created asc
+        limit %s
+        """,
+        (add_to_date(now_datetime(), minutes=-DRAIN_GRACE_MINUTES), MAX_ATTEMPTS, DRAIN_BATCH_SIZE)
+    )
+
+    for (event_id,) in events:
+        process_event(event_id)
+
+
+@frappe.whitelist()
+def replay_webhook_events(event_ids=None, from_datetime=None, to_datetime=None, event_type=None, status=None):
+    """Run stored events again, e.g. after an incident; filters select the events to replay"""
+    frappe.only_for("System Manager")
+
+    filters = {}
+    if event_ids:
+        filters["name"] = ["in", json.loads(event_ids) if isinstance(event_ids, str) else event_ids]
+    if from_datetime and to_datetime:
+        filters["event_created"] = ["between", [from_datetime, to_datetime]]
+    elif from_datetime:
+        filters["event_created"] = [">=", from_datetime]
+    elif to_datetime:
+        filters["event_created"] = ["<=", to_datetime]
+    if event_type:
+        filters["event_type"] = event_type
+    if status:
+        filters["status"] = status
+
+    if not filters:
+        frappe.throw("Select the events to replay")
+
+    events = frappe.get_all("Stripe Webhook Event", filters=filters, pluck="name")
+    for event_id in events:
+        frappe.db.set_value("Stripe Webhook Event", event_id, {
+            "status": "Pending",
+            "attempts": 0,
+            "error": None
+        }, update_modified=False)
+
+    frappe.db.commit()
+
+    if events:
+        frappe.enqueue(
+            "zerp.zerp.webhook_inbox.replay_pending_events",
+            queue="long",
+            timeout=3600,
+            event_ids=events
+        )
+    return {
+        "success": True,
+        "message": f"{len(events)} events have been queued for replay"
+    }
+
+
+def replay_pending_events(event_ids):
+    """Process replayed events in the order Stripe created them"""
+    ordered = frappe.get_all(
+        "Stripe Webhook Event",
+        filters={"name": ["in", event_ids], "status": "Pending"},
+        order_by="event_created asc",
+        pluck="name"
+    )
+    for event_id in ordered:
+        process_event(event_id)